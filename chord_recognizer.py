@@ -0,0 +1,59 @@
+import numpy as np
+
+# chord types we can recognize, as semitone intervals above the root
+CHORD_TYPES = (
+    ("major", (0, 4, 7)),
+    ("minor", (0, 3, 7)),
+    ("diminished", (0, 3, 6)),
+    ("sus2", (0, 2, 7)),
+    ("sus4", (0, 5, 7)),
+)
+
+# builds one unit-length 12-bin chroma template per (root, chord type).
+# Returns the (num_chords, 12) template matrix and a matching list of
+# (root, chord_type) labels
+def make_chord_templates():
+    templates = []
+    labels = []
+    for chord_type, intervals in CHORD_TYPES:
+        for root in range(12):
+            template = np.zeros(12)
+            for interval in intervals:
+                template[(root + interval) % 12] = 1.0
+            templates.append(template / np.linalg.norm(template))
+            labels.append( (root, chord_type) )
+    return np.array(templates), labels
+
+class ChordRecognizer(object):
+    def __init__(self, time_constant = 2.0):
+        self.time_constant = time_constant # seconds for old pitches to fade by 1/e
+        self.templates, self.labels = make_chord_templates()
+
+        self.chroma = np.zeros(12)
+        self.last_t = None
+
+    def clear(self):
+        self.chroma[:] = 0
+        self.last_t = None
+
+    # adds a detected pitch at time t. weight should reflect how much energy
+    # (and confidence) the pitch was detected with
+    def add_pitch(self, t, pitch, weight = 1.0):
+        if self.last_t is not None and t > self.last_t:
+            self.chroma *= np.exp((self.last_t - t) / self.time_constant)
+        self.last_t = t
+
+        self.chroma[int(round(pitch)) % 12] += weight
+
+    # returns (root, chord_type, confidence) for the template that best matches
+    # the pitches heard so far, or None if nothing has been heard. root is a
+    # pitch class (0 = C) and confidence is the cosine similarity in [0, 1]
+    def get_chord(self):
+        norm = np.linalg.norm(self.chroma)
+        if norm == 0:
+            return None
+
+        scores = self.templates.dot(self.chroma) / norm
+        best = np.argmax(scores)
+        root, chord_type = self.labels[best]
+        return (root, chord_type, float(scores[best]))
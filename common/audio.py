@@ -17,22 +17,41 @@ import numpy as np
 from common import core
 import time
 import os.path
+from collections import deque
 from configparser import ConfigParser
 
+# max number of audio blocks that can wait for the UI thread in callback mode
+kMaxQueuedBlocks = 64
+
 
 class Audio(object):
     # global variable: might change when Audio driver is set up.
     sample_rate = 44100
 
-    def __init__(self, num_channels, listen_func = None, input_func = None):
+    # if use_callback is True, audio is generated in the PyAudio stream
+    # callback (on PyAudio's own thread) instead of in on_update(). Input
+    # and listen data are then handed to the UI thread through deques, and
+    # input_func / listen_func still get called from on_update().
+    def __init__(self, num_channels, listen_func = None, input_func = None, use_callback = False):
         super(Audio, self).__init__()
 
         assert(num_channels == 1 or num_channels == 2)
         self.num_channels = num_channels
         self.listen_func = listen_func
         self.input_func = input_func
+        self.use_callback = use_callback
         self.audio = pyaudio.PyAudio()
 
+        # deque append / popleft are atomic, so the audio thread and the UI
+        # thread can share these without a lock
+        self.input_blocks = deque(maxlen = kMaxQueuedBlocks)
+        self.listen_blocks = deque(maxlen = kMaxQueuedBlocks)
+
+        # in callback mode, the stream starts (and may call _stream_callback)
+        # inside open(), so everything the callback reads is set up before
+        self.generator = None
+        self.cpu_time = 0
+
         out_dev, in_dev, buffer_size, sr = self._get_parameters()
         Audio.sample_rate = sr
 
@@ -44,10 +63,9 @@ class Audio(object):
                                       output = True,
                                       input = input_func != None,
                                       output_device_index = out_dev,
-                                      input_device_index = in_dev)
+                                      input_device_index = in_dev,
+                                      stream_callback = self._stream_callback if use_callback else None)
 
-        self.generator = None
-        self.cpu_time = 0
         core.register_terminate_func(self.close)
 
     def close(self) :
@@ -67,6 +85,10 @@ class Audio(object):
 
     # must call this every frame.
     def on_update(self):
+        if self.use_callback:
+            self._process_queued_blocks()
+            return
+
         t_start = time.time()
 
         # get input audio if desired
@@ -75,34 +97,75 @@ class Audio(object):
                 num_frames = self.stream.get_read_available() # number of frames to ask for
                 if num_frames:
                     data_str = self.stream.read(num_frames, False)
-                    data_np = np.fromstring(data_str, dtype=np.float32)
+                    data_np = np.frombuffer(data_str, dtype=np.float32)
                     self.input_func(data_np, self.num_channels)
             except IOError as e:
                 print('got error', e)
 
         # Ask the generator to generate some audio samples.
         num_frames = self.stream.get_write_available() # number of frames to supply
-        if self.generator and num_frames != 0:
-            (data, continue_flag) = self.generator.generate(num_frames, self.num_channels)
+        if num_frames != 0:
+            data = self._generate(num_frames)
+            if data is not None:
+                self.stream.write(data.tobytes())
 
-            # make sure we got the correct number of frames that we requested
-            assert len(data) == num_frames * self.num_channels, \
-                "asked for (%d * %d) frames but got %d" % (num_frames, self.num_channels, len(data))
+                # send data to listerner as well
+                if self.listen_func:
+                    self.listen_func(data, self.num_channels)
 
-            # convert type if needed and write to stream
-            if data.dtype != np.float32:
-                data = data.astype(np.float32)
-            self.stream.write(data.tostring())
+        self._update_cpu_time(t_start)
 
-            # send data to listerner as well
-            if self.listen_func:
-                self.listen_func(data, self.num_channels)
-
-            # continue flag
-            if not continue_flag:
-                self.generator = None
+    # called by PyAudio on its own thread when use_callback is True.
+    def _stream_callback(self, in_data, frame_count, time_info, status):
+        t_start = time.time()
 
-        # how long this all took
+        if self.input_func and in_data:
+            self.input_blocks.append(np.frombuffer(in_data, dtype=np.float32))
+
+        data = self._generate(frame_count)
+        if data is None:
+            data = np.zeros(frame_count * self.num_channels, dtype=np.float32)
+        elif self.listen_func:
+            # generators may reuse their buffers, so keep a copy for the UI
+            self.listen_blocks.append(data.copy())
+
+        self._update_cpu_time(t_start)
+        return (data.tobytes(), pyaudio.paContinue)
+
+    # hand blocks that arrived on the audio thread to input_func / listen_func
+    def _process_queued_blocks(self):
+        while self.input_blocks:
+            self.input_func(self.input_blocks.popleft(), self.num_channels)
+        while self.listen_blocks:
+            self.listen_func(self.listen_blocks.popleft(), self.num_channels)
+
+    # ask the generator for num_frames of audio. Returns None if there is no
+    # generator.
+    def _generate(self, num_frames):
+        # hold on to the generator in case set_generator() is called from
+        # another thread while we are generating
+        gen = self.generator
+        if not gen:
+            return None
+
+        (data, continue_flag) = gen.generate(num_frames, self.num_channels)
+
+        # make sure we got the correct number of frames that we requested
+        assert len(data) == num_frames * self.num_channels, \
+            "asked for (%d * %d) frames but got %d" % (num_frames, self.num_channels, len(data))
+
+        # convert type if needed
+        if data.dtype != np.float32:
+            data = data.astype(np.float32)
+
+        # continue flag
+        if not continue_flag and self.generator is gen:
+            self.generator = None
+
+        return data
+
+    # how long this all took
+    def _update_cpu_time(self, t_start):
         dt = time.time() - t_start
         a = 0.9
         self.cpu_time = a * self.cpu_time + (1-a) * dt
@@ -9,6 +9,11 @@
 #####################################################################
 
 import time
+import heapq
+import itertools
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
 import numpy as np
 from .audio import Audio
 
@@ -56,30 +61,77 @@ class Clock(object):
 # For tempo maps - converting bpm to ticks
 kTicksPerQuarter = 480
 
+# Tempo map made of constant-tempo segments. Every set_tempo() starts a new
+# segment, so times and ticks before a tempo change keep converting the way
+# they did when they were played.
 class SimpleTempoMap(object):
 
     def __init__(self, bpm = 120) :
         super(SimpleTempoMap, self).__init__()
+        # (seg_times, seg_ticks, seg_bpms): segment i starts at seg_times[i]
+        # (seconds) / seg_ticks[i] and runs at seg_bpms[i] until the next
+        # segment starts. The audio thread converts ticks while the UI thread
+        # sets tempos, so set_tempo() builds new arrays and publishes them with
+        # one assignment, and readers take self.segments once per call.
+        self.segments = (array('d', [0.]), array('d', [0.]), array('d', [bpm]))
+
+        # tempo and tick offset of the latest segment
         self.bpm = bpm
         self.tick_offset = 0
 
     def time_to_tick(self, time) :
-        slope = (kTicksPerQuarter * self.bpm) / 60.
-        tick = slope * time + self.tick_offset
+        seg_times, seg_ticks, seg_bpms = self.segments
+        i = max(bisect_right(seg_times, time) - 1, 0)
+        slope = (kTicksPerQuarter * seg_bpms[i]) / 60.
+        tick = seg_ticks[i] + slope * (time - seg_times[i])
         return tick
 
     def tick_to_time(self, tick) :
-        slope = (kTicksPerQuarter * self.bpm) / 60.
-        time = (tick - self.tick_offset) / slope
+        seg_times, seg_ticks, seg_bpms = self.segments
+        i = max(bisect_right(seg_ticks, tick) - 1, 0)
+        slope = (kTicksPerQuarter * seg_bpms[i]) / 60.
+        time = seg_times[i] + (tick - seg_ticks[i]) / slope
         return time
 
+    # vectorized time_to_tick for an array of times
+    def times_to_ticks(self, times) :
+        seg_times, seg_ticks, slopes = self._segment_arrays()
+        times = np.asarray(times, dtype=np.float64)
+        i = np.maximum(np.searchsorted(seg_times, times, side='right') - 1, 0)
+        return seg_ticks[i] + slopes[i] * (times - seg_times[i])
+
+    # vectorized tick_to_time for an array of ticks
+    def ticks_to_times(self, ticks) :
+        seg_times, seg_ticks, slopes = self._segment_arrays()
+        ticks = np.asarray(ticks, dtype=np.float64)
+        i = np.maximum(np.searchsorted(seg_ticks, ticks, side='right') - 1, 0)
+        return seg_times[i] + (ticks - seg_ticks[i]) / slopes[i]
+
+    def _segment_arrays(self) :
+        seg_times, seg_ticks, seg_bpms = self.segments
+        slopes = np.array(seg_bpms) * (kTicksPerQuarter / 60.)
+        return np.array(seg_times), np.array(seg_ticks), slopes
+
     # buggy way of setting new tempo
     # def set_tempo(self, bpm, cur_time):
     #    self.bpm = bpm
 
-    # better way of setting new tempo: maintain tick continuity
+    # better way of setting new tempo: maintain tick continuity.
+    # The new tempo applies from cur_time on, and replaces any tempo changes
+    # that were set for later times.
     def set_tempo(self, bpm, cur_time):
+        seg_times, seg_ticks, seg_bpms = self.segments
         cur_tick = self.time_to_tick(cur_time)
+
+        n = bisect_left(seg_times, cur_time)
+        seg_times = seg_times[:n]
+        seg_ticks = seg_ticks[:n]
+        seg_bpms = seg_bpms[:n]
+        seg_times.append(cur_time)
+        seg_ticks.append(cur_tick)
+        seg_bpms.append(bpm)
+        self.segments = (seg_times, seg_ticks, seg_bpms)
+
         self.bpm = bpm
         slope = (kTicksPerQuarter * self.bpm) / 60.
         self.tick_offset = cur_tick - cur_time * slope
@@ -96,18 +148,23 @@ def tick_str(tick) :
 # where each point is (time, tick)
 # optionally pass in filepath instead which will
 # read the file to create the list of (time, tick) points
-# TempoMap will linearly interpolate this graph
+# TempoMap will linearly interpolate this graph.
+# time_to_tick / tick_to_time also accept numpy arrays and convert every
+# element in a single call.
 class TempoMap(object):
     def __init__(self, data = None, filepath = None):
         super(TempoMap, self).__init__()
 
-        if data == None:
+        if data is None:
             data = self._read_tempo_data(filepath)
 
-        assert(data[0] == (0,0))
+        data = np.asarray(data, dtype=np.float64)
         assert(len(data) > 1)
+        assert(data[0, 0] == 0 and data[0, 1] == 0)
 
-        self.times, self.ticks = list(zip(*data))
+        # contiguous arrays, so np.interp doesn't have to convert them per call
+        self.times = np.ascontiguousarray(data[:, 0])
+        self.ticks = np.ascontiguousarray(data[:, 1])
 
     def time_to_tick(self, time) :
         tick = np.interp(time, self.times, self.ticks)
@@ -117,17 +174,13 @@ class TempoMap(object):
         time = np.interp(tick, self.ticks, self.times)
         return time
 
+    # reads a tab separated file of (time, beats) lines into an (n, 2) array
+    # of (time, tick) points
     def _read_tempo_data(self, filepath):
-        data = [(0,0)]
-
-        for line in open(filepath).readlines():
-            (time, beats) = line.strip().split('\t')
-            time = float(time)
-
-            delta_tick = float(beats) * kTicksPerQuarter
-            last_tick = data[-1][1]
-            data.append( (time, last_tick + delta_tick))
-
+        lines = np.loadtxt(filepath, delimiter='\t', ndmin=2)
+        data = np.zeros((len(lines) + 1, 2))
+        data[1:, 0] = lines[:, 0]
+        data[1:, 1] = np.cumsum(lines[:, 1] * kTicksPerQuarter)
         return data
 
 
@@ -136,7 +189,7 @@ class Scheduler(object):
         super(Scheduler, self).__init__()
         self.clock = clock
         self.tempo_map = tempo_map
-        self.commands = []
+        self.commands = CommandQueue()
 
     def get_time(self) :
         return self.clock.get_time()
@@ -146,32 +199,25 @@ class Scheduler(object):
         return self.tempo_map.time_to_tick(sec)
 
     # add a record for the function to call at the particular tick
-    # keep the list of commands sorted from lowest to hightest tick
-    # make sure tick is the first argument so sorting will work out
-    # properly
     def post_at_tick(self, func, tick, arg = None) :
-        now_tick = self.get_tick()
-
         cmd = Command(tick, func, arg)
-        self.commands.append(cmd)
-        self.commands.sort(key = lambda x: x.tick)
+        self.commands.push(cmd)
         return cmd
 
     # attempt a removal. Does nothing if cmd is not found
     def remove(self, cmd):
-        if cmd in self.commands:
-            idx = self.commands.index(cmd)
-            del self.commands[idx]
+        self.commands.remove(cmd)
 
     # on_update should be called as often as possible.
     # the only trick here is to make sure we remove the command BEFORE
     # calling the command's function so we handle re-entry properly.
     def on_update(self):
         now_tick = self.get_tick()
-        while self.commands:
-            if self.commands[0].tick <= now_tick:
-                command = self.commands.pop(0)
-                command.execute()
+        while True:
+            command = self.commands.peek()
+            if command is not None and command.tick <= now_tick:
+                if self.commands.pop(command):
+                    command.execute()
             else:
                 break
 
@@ -186,36 +232,60 @@ class Scheduler(object):
 # AudioScheduler is a Scheduler and Clock built into one class.
 # It is ALSO a Generator. For it to work, it must be inserted into
 # and Audio generator chain.
+# The generator is typically a Mixer, so that every generator in the mix hears
+# commands at the exact audio frame they are scheduled for.
 class AudioScheduler(object):
-    def __init__(self, tempo_map) :
+    # commands are never allowed to split off a sub-block shorter than
+    # min_block_frames. A command inside such a short span is delayed to its
+    # end, together with any other commands that fall in the same span. A
+    # command that would leave a shorter tail before the end of the block is
+    # delayed to the end of the block.
+    def __init__(self, tempo_map, min_block_frames = 32) :
         super(AudioScheduler, self).__init__()
         self.tempo_map = tempo_map
-        self.commands = []
+        self.commands = CommandQueue()
+        self.min_block_frames = min_block_frames
 
         self.generator = None
         self.cur_frame = 0
 
+        # output buffer, reused across calls and grown as needed
+        self.buffer = np.zeros(0, dtype=np.float32)
+
     def set_generator(self, gen) :
         self.generator = gen
 
+    # the returned array is a view into a buffer owned by the AudioScheduler.
+    # It is only valid until the next call to generate().
     def generate(self, num_frames, num_channels) :
-        output = np.empty(num_channels * num_frames, dtype = np.float32)
+        size = num_channels * num_frames
+        if len(self.buffer) < size:
+            self.buffer = np.zeros(size, dtype = np.float32)
+        output = self.buffer[:size]
         o_idx = 0
 
         # the current period of time goes from self.cur_frame to end_frame
         end_frame = self.cur_frame + num_frames
 
         # advance time and fire off commands for this time frame
-        while self.commands:
+        while True:
+            command = self.commands.peek()
+            if command is None:
+                break
+
             # find the exact frame at which the next command should happen
-            cmd_tick = self.commands[0].tick
+            cmd_tick = command.tick
             cmd_time = self.tempo_map.tick_to_time(cmd_tick)
             cmd_frame = int(cmd_time * Audio.sample_rate)
 
             if cmd_frame < end_frame:
+                if cmd_frame > self.cur_frame:
+                    cmd_frame = min(max(cmd_frame, self.cur_frame + self.min_block_frames), end_frame)
+                    if end_frame - cmd_frame < self.min_block_frames:
+                        cmd_frame = end_frame
                 o_idx = self._generate_until(cmd_frame, num_channels, output, o_idx)
-                command = self.commands.pop(0)
-                command.execute()
+                if self.commands.pop(command):
+                    command.execute()
             else:
                 break
 
@@ -227,13 +297,13 @@ class AudioScheduler(object):
     def _generate_until(self, to_frame, num_channels, output, o_idx) :
         num_frames = to_frame - self.cur_frame
         if num_frames > 0:
+            next_o_idx = o_idx+(num_channels * num_frames)
             if self.generator:
                 data, cont = self.generator.generate(num_frames, num_channels)
+                output[o_idx : next_o_idx] = data
             else:
-                data = np.zeros(num_channels * num_frames, dtype=np.float32)
+                output[o_idx : next_o_idx] = 0
 
-            next_o_idx = o_idx+(num_channels * num_frames)
-            output[o_idx : next_o_idx] = data
             self.cur_frame += num_frames
             return next_o_idx
         else:
@@ -248,20 +318,13 @@ class AudioScheduler(object):
 
     # add a record for the function to call at the particular tick
     def post_at_tick(self, func, tick, arg = None) :
-        now_time  = self.get_time()
-        post_time = self.tempo_map.tick_to_time(tick)
-
-        # create a command to hold the function/arg and sort by tick
         cmd = Command(tick, func, arg)
-        self.commands.append(cmd)
-        self.commands.sort(key = lambda x: x.tick)
+        self.commands.push(cmd)
         return cmd
 
     # attempt a removal. Does nothing if cmd is not found
     def remove(self, cmd):
-        if cmd in self.commands:
-            idx = self.commands.index(cmd)
-            del self.commands[idx]
+        self.commands.remove(cmd)
 
     def now_str(self):
         time = self.get_time()
@@ -271,6 +334,70 @@ class AudioScheduler(object):
         return txt
 
 
+# Priority queue of Commands ordered by tick. Commands with the same tick come
+# out in the order they were pushed. Removal just clears the command out of its
+# heap entry (a tombstone), and the entry is discarded when it reaches the
+# front, so push, remove and pop are all O(log n).
+# Commands are posted and removed on the UI thread while an AudioScheduler
+# pops them on the audio thread, so all access goes through a lock.
+class CommandQueue(object):
+    def __init__(self):
+        super(CommandQueue, self).__init__()
+        self.heap = [] # entries are [tick, sequence number, cmd or None]
+        self.sequence = itertools.count()
+        self.num_cancelled = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap) - self.num_cancelled
+
+    def push(self, cmd):
+        with self.lock:
+            entry = [cmd.tick, next(self.sequence), cmd]
+            cmd.queue_entry = entry
+            heapq.heappush(self.heap, entry)
+
+    # Does nothing if cmd is not in the queue
+    def remove(self, cmd):
+        with self.lock:
+            entry = getattr(cmd, 'queue_entry', None)
+            if entry is None or entry[2] is not cmd:
+                return
+            entry[2] = None
+            cmd.queue_entry = None
+            self.num_cancelled += 1
+
+            # rebuild once tombstones make up most of the heap
+            if self.num_cancelled > 32 and self.num_cancelled * 2 > len(self.heap):
+                self.heap = [e for e in self.heap if e[2] is not None]
+                heapq.heapify(self.heap)
+                self.num_cancelled = 0
+
+    # returns the command with the lowest tick without removing it, or None
+    def peek(self):
+        with self.lock:
+            self._discard_cancelled()
+            return self.heap[0][2] if self.heap else None
+
+    # removes and returns the command with the lowest tick, or None. If cmd
+    # is given, only pops it if it is still the command with the lowest tick
+    # (it may have been removed or overtaken since it was peeked).
+    def pop(self, cmd = None):
+        with self.lock:
+            self._discard_cancelled()
+            if not self.heap or (cmd is not None and self.heap[0][2] is not cmd):
+                return None
+            cmd = heapq.heappop(self.heap)[2]
+            cmd.queue_entry = None
+            return cmd
+
+    def _discard_cancelled(self):
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+            self.num_cancelled -= 1
+
+
 class Command(object):
     def __init__(self, tick, func, arg):
         super(Command, self).__init__()
@@ -279,6 +406,9 @@ class Command(object):
         self.arg = arg
         self.did_it = False
 
+        # heap entry while the command is in a CommandQueue
+        self.queue_entry = None
+
     def execute(self):
         # ensure that execute only gets called once.
         if not self.did_it:
@@ -168,6 +168,16 @@ fluid_synth_write_s16 = cfunc('fluid_synth_write_s16', c_void_p,
                               ('roff', c_int, 1),
                               ('rincr', c_int, 1))
 
+fluid_synth_write_float = cfunc('fluid_synth_write_float', c_int,
+                                ('synth', c_void_p, 1),
+                                ('len', c_int, 1),
+                                ('lbuf', c_void_p, 1),
+                                ('loff', c_int, 1),
+                                ('lincr', c_int, 1),
+                                ('rbuf', c_void_p, 1),
+                                ('roff', c_int, 1),
+                                ('rincr', c_int, 1))
+
 class fluid_synth_channel_info_t(Structure):
     _fields_ = [
         ('assigned', c_int),
@@ -395,7 +405,18 @@ def fluid_synth_write_s16_stereo(synth, len):
     import numpy
     buf = create_string_buffer(len * 4)
     fluid_synth_write_s16(synth, len, buf, 0, 2, buf, 1, 2)
-    return numpy.fromstring(buf[:], dtype=numpy.int16)
+    return numpy.frombuffer(buf, dtype=numpy.int16)
+
+def fluid_synth_write_float_stereo(synth, len, out):
+    """Render samples in interleaved stereo 32-bit float format into out
+
+    out must be a contiguous float32 Numpy array of at least 2 * len
+    samples. It is written to directly, without any intermediate copy.
+
+    """
+    ptr = out.ctypes.data
+    fluid_synth_write_float(synth, len, ptr, 0, 2, ptr, 1, 2)
+    return out
 
 
 # Object-oriented interface, simplifies access to functions
@@ -644,6 +665,14 @@ class Synth:
 
         """
         return fluid_synth_write_s16_stereo(self.synth, len)
+    def write_samples(self, out, len=1024):
+        """Generate audio samples into a preallocated float32 NumPy array
+
+        out receives len interleaved stereo frames as floats in [-1, 1].
+
+        """
+        assert out.dtype.name == 'float32' and out.flags['C_CONTIGUOUS'] and out.size >= 2 * len
+        return fluid_synth_write_float_stereo(self.synth, len, out)
 
 class Sequencer:
     def __init__(self, time_scale=1000, use_system_timer=True):
@@ -14,13 +14,14 @@ from .clock import kTicksPerQuarter, quantize_tick_up
 class Metronome(object):
     """Plays a steady click every beat.
     """
-    def __init__(self, sched, synth, channel = 0, patch=(128, 0), pitch = 60):
+    def __init__(self, sched, synth, channel = 0, patch=(128, 0), pitch = 60, velocity = 60):
         super(Metronome, self).__init__()
         self.sched = sched
         self.synth = synth
         self.channel = channel
         self.patch = patch
         self.pitch = pitch
+        self.velocity = velocity
         self.beat_len = kTicksPerQuarter
 
         # run-time variables
@@ -71,7 +72,7 @@ class Metronome(object):
     def _noteon(self, tick, ignore):
         self.synth.program(self.channel, self.patch[0], self.patch[1])
         # play the note right now:
-        self.synth.noteon(self.channel, self.pitch, 60)
+        self.synth.noteon(self.channel, self.pitch, self.get_velocity(tick))
 
         # post the note off for half a beat later:
         self.off_cmd = self.sched.post_at_tick(self._noteoff, tick + self.beat_len/2, self.pitch)
@@ -80,6 +81,10 @@ class Metronome(object):
         next_beat = tick + self.beat_len
         self.on_cmd = self.sched.post_at_tick(self._noteon, next_beat)
 
+    # velocity of the click on the given beat tick. Override to add accents.
+    def get_velocity(self, tick):
+        return self.velocity
+
     def _noteoff(self, tick, pitch):
         # just turn off the currently sounding note.
         self.synth.noteoff(self.channel, pitch)
@@ -17,12 +17,22 @@ class Mixer(object):
         self.generators = []
         self.gain = 1.0;
 
+        # per-generator gain. Generators not in here play at gain 1.0
+        self.generator_gains = {}
+        self.muted = set()
+
+        # output and scratch buffers, reused across calls and grown as needed
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.scratch = np.zeros(0, dtype=np.float32)
+
     def add(self, gen) :
         if gen not in self.generators:
             self.generators.append(gen)
 
     def remove(self, gen) :
         self.generators.remove(gen)
+        self.generator_gains.pop(gen, None)
+        self.muted.discard(gen)
 
     def set_gain(self, gain) :
         self.gain = np.clip(gain, 0, 1)
@@ -30,11 +40,34 @@ class Mixer(object):
     def get_gain(self) :
         return self.gain
 
+    def set_generator_gain(self, gen, gain) :
+        self.generator_gains[gen] = np.clip(gain, 0, 1)
+
+    def get_generator_gain(self, gen) :
+        return self.generator_gains.get(gen, 1.0)
+
+    # a muted generator keeps generating (so it stays in time) but isn't heard
+    def set_mute(self, gen, muted) :
+        if muted:
+            self.muted.add(gen)
+        else:
+            self.muted.discard(gen)
+
+    def is_muted(self, gen) :
+        return gen in self.muted
+
     def get_num_generators(self) :
         return len(self.generators)
 
+    # the returned array is a view into a buffer owned by the Mixer. It is
+    # only valid until the next call to generate().
     def generate(self, num_frames, num_channels) :
-        output = np.zeros(num_frames * num_channels)
+        size = num_frames * num_channels
+        if len(self.buffer) < size:
+            self.buffer = np.zeros(size, dtype=np.float32)
+            self.scratch = np.zeros(size, dtype=np.float32)
+        output = self.buffer[:size]
+        output.fill(0)
 
         # this calls generate() for each generator. generator must return:
         # (signal, keep_going). If keep_going is True, it means the generator
@@ -44,13 +77,22 @@ class Mixer(object):
         kill_list = []
         for g in self.generators:
             (signal, keep_going) = g.generate(num_frames, num_channels)
-            output += signal
+            if g not in self.muted:
+                gain = self.generator_gains.get(g, 1.0)
+                n = len(signal)
+                if gain == 1.0:
+                    output[:n] += signal
+                elif gain > 0:
+                    scaled = self.scratch[:n]
+                    np.multiply(signal, gain, out=scaled, casting='unsafe')
+                    output[:n] += scaled
             if not keep_going:
                 kill_list.append(g)
 
         # remove generators that are done
         for g in kill_list:
-            self.generators.remove(g)
+            self.remove(g)
 
-        output *= self.gain
+        if self.gain != 1.0:
+            output *= self.gain
         return (output, True)
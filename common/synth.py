@@ -9,6 +9,8 @@
 #####################################################################
 
 import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from . import fluidsynth
 from .audio import Audio
 
@@ -22,13 +24,101 @@ class Synth(fluidsynth.Synth, object):
             raise Exception('Error in fluidsynth.sfload(): cannot open ' + filepath)
         self.program(0, 0, 0)
 
+        # render buffer, reused across calls and grown as needed
+        self.buffer = np.zeros(0, dtype=np.float32)
+
     def program(self, chan, bank, preset):
         self.program_select(chan, self.sfid, bank, preset)
 
+    # the returned array is a view into a buffer owned by the Synth. It is
+    # only valid until the next call to generate().
     def generate(self, num_frames, num_channels):
         assert(num_channels == 2)
-        # get_samples() returns interleaved stereo, so all we have to do is scale
-        # the data to [-1, 1].
-        samples = self.get_samples(num_frames).astype(np.float32)
-        samples *= (1.0/32768.0)
+        size = num_frames * num_channels
+        if len(self.buffer) < size:
+            self.buffer = np.zeros(size, dtype=np.float32)
+
+        # fluidsynth renders interleaved stereo floats in [-1, 1] straight
+        # into our buffer.
+        samples = self.buffer[:size]
+        self.write_samples(samples, num_frames)
         return (samples, True)
+
+
+# Loads each SoundFont once into a shared Synth and hands out MIDI channels on
+# it, so that several voices (e.g. metronome and performance) can share one
+# engine instead of each parsing and holding their own copy of the SoundFont.
+# SoundFonts can also be loaded in the background with load_async().
+class SynthPool(object):
+    def __init__(self, gain = 1.0):
+        super(SynthPool, self).__init__()
+        self.gain = gain
+        self.synths = {}        # filepath -> Synth
+        self.next_channels = {} # filepath -> next free channel
+
+        self.lock = threading.Lock()
+        self.executor = None
+        self.loads = {}         # filepath -> Future of a background load
+        self.ready_funcs = []   # (future, func) pairs waiting for on_update()
+
+    # returns the shared Synth for filepath, loading the SoundFont if needed.
+    # Blocks if the SoundFont is being loaded on another thread.
+    def get_synth(self, filepath):
+        with self.lock:
+            if filepath not in self.synths:
+                self.synths[filepath] = Synth(filepath, self.gain)
+            return self.synths[filepath]
+
+    # starts loading the SoundFont on a background thread and returns a Future
+    # for the shared Synth. If ready_func is given, on_update() calls
+    # ready_func(synth) once the SoundFont is loaded.
+    def load_async(self, filepath, ready_func = None):
+        if filepath not in self.loads:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers = 1)
+            self.loads[filepath] = self.executor.submit(self.get_synth, filepath)
+
+        future = self.loads[filepath]
+        if ready_func:
+            self.ready_funcs.append( (future, ready_func) )
+        return future
+
+    def is_ready(self, filepath):
+        return filepath in self.synths
+
+    # fraction of the background loads that have finished, for startup progress
+    def get_load_progress(self):
+        if not self.loads:
+            return 1.0
+        num_done = len([f for f in self.loads.values() if f.done()])
+        return num_done / float(len(self.loads))
+
+    # call this every frame from the UI thread. Calls the ready_funcs of
+    # SoundFonts that have finished loading.
+    def on_update(self):
+        if not self.ready_funcs:
+            return
+
+        done = [(f, func) for (f, func) in self.ready_funcs if f.done()]
+        self.ready_funcs = [(f, func) for (f, func) in self.ready_funcs if not f.done()]
+        for (future, func) in done:
+            # result() re-raises here if the SoundFont failed to load
+            func(future.result())
+
+    # reserves a MIDI channel on the shared Synth for filepath. Channel 9 is
+    # skipped, since General MIDI treats it as the percussion channel.
+    def allocate_channel(self, filepath):
+        chan = self.next_channels.get(filepath, 0)
+        if chan == 9:
+            chan += 1
+        self.next_channels[filepath] = chan + 1
+        return chan
+
+
+# the app-wide pool of shared synths
+gSynthPool = None
+def get_synth_pool():
+    global gSynthPool
+    if not gSynthPool:
+        gSynthPool = SynthPool()
+    return gSynthPool
@@ -2,28 +2,63 @@
 from leaputil import *
 
 import Leap
+import time
 import numpy as np
+from ring_buffer import RingBuffer
 
 # USING KINECT INSTEAD
 
+# hands tracked by the recognizer, in the order of its (num_hands, ...) arrays
+HAND_SIDES = ("left", "right")
+
+# gesture classifications, and the columns of GestureRecognizer.gesture_timeouts
+GESTURES = ("none", "fist", "up_conduct", "down_conduct", "piano")
+NONE, FIST, UP_CONDUCT, DOWN_CONDUCT, PIANO = range(len(GESTURES))
+
+# average rate of change from each hand's samples taken within timespan
+# seconds of t (and not before that hand's since time) to its current value at
+# time t. values is (num_samples, num_hands, ...), times is (num_samples,) and
+# value is (num_hands, ...). Hands without such samples get 0
+def windowed_rate(values, times, value, t, timespan, since = None):
+    start = t - timespan
+    if since is not None:
+        start = np.maximum(start, since)
+    extra_dims = (1,) * (values.ndim - 2)
+
+    valid = times[:, np.newaxis] >= start
+    elapsed = (t - times + 0.00001).reshape((-1, 1) + extra_dims)
+    rates = np.where(valid.reshape(valid.shape + extra_dims), (value - values) / elapsed, 0.0)
+    counts = np.maximum(np.sum(valid, axis=0), 1).reshape((-1,) + extra_dims)
+    return np.sum(rates, axis=0) / counts
+
 class GestureRecognizer(object):
-    def __init__(self, quantize_func, play_func, tempo_processor, tempo_map):
-        self.leap = Leap.Controller()
+    # Live Leap frames are captured by a LeapCapture listener on the Leap
+    # service's thread, and each one is processed exactly once in on_update.
+    # leap_source is a SensorReplay (or anything with its add_leap_listener()
+    # and leap_frame_time) to take Leap frames from instead of the live Leap;
+    # each of its frames is processed once as it is delivered. If recorder (a
+    # SensorRecorder) is given, all live Leap frames are recorded to it.
+    def __init__(self, quantize_func, play_func, tempo_processor, tempo_map, leap_source = None, recorder = None):
+        self.leap_source = leap_source
+        self.recorder = recorder
+        self.last_frame_time = None # device time of the latest processed Leap frame
+        if self.leap_source == None:
+            self.leap = Leap.Controller()
+            self.leap_capture = LeapCapture()
+            self.leap.add_listener(self.leap_capture)
+        else:
+            self.leap_source.add_leap_listener(self.on_leap_frame)
         self.quantize_func = quantize_func
         self.play_func = play_func
         self.tempo_processor = tempo_processor
         self.tempo_map = tempo_map
 
-        self.gesture_timeouts = {
-            "leftfist": 0,
-            "leftpiano": 0,
-            "leftup_conduct": 0,
-            "leftdown_conduct": 0,
-            "rightfist": 0,
-            "rightpiano": 0,
-            "rightup_conduct": 0,
-            "rightdown_conduct": 0
-        }
+        # all per-hand state is kept in arrays with one row per hand, so
+        # every hand goes through each stage in the same array operations
+        self.num_hands = len(HAND_SIDES)
+
+        # seconds until each hand can trigger each gesture again
+        self.gesture_timeouts = np.zeros((self.num_hands, len(GESTURES)))
 
         self.t = 0
         self.speed_timespan = 0.04 # in seconds
@@ -32,256 +67,171 @@ class GestureRecognizer(object):
         self.acceleration_threshold = 5000
         self.acceleration_stop_threshold = 250
 
-        self.left_hand_available = False
-        self.right_hand_available = False
-        self.left_palm_pos_over_time = []
-        self.right_palm_pos_over_time = []
-        self.left_palm_vel_over_time = []
-        self.right_palm_vel_over_time = []
-
-        self.clustered_left_palm_acc = []
-        self.clustered_right_palm_acc = []
-
-        self.left_palm_velocity = np.array((0.0, 0.0, 0.0))
-        self.right_palm_velocity = np.array((0.0, 0.0, 0.0))
-        self.left_palm_acceleration = 0.0
-        self.right_palm_acceleration = 0.0
-
-    def finger_span(self, fingers):
-        min_x = -1
-        min_y = -1
-        min_z = -1
-        max_x = -1
-        max_y = -1
-        max_z = -1
-        for finger in fingers:
-            if min_x == -1:
-                min_x = finger[0]
-            if max_x == -1:
-                max_x = finger[0]
-
-            if min_y == -1:
-                min_y = finger[1]
-            if max_y == -1:
-                max_y = finger[1]
-
-            if min_z == -1:
-                min_z = finger[2]
-            if max_z == -1:
-                max_z = finger[2]
-
-            min_x = min(min_x, finger[0])
-            max_x = max(max_x, finger[0])
-            min_y = min(min_y, finger[1])
-            max_y = max(max_y, finger[1])
-            min_z = min(min_z, finger[2])
-            max_z = max(max_z, finger[2])
-
-        return [max_x-min_x, max_y-min_y, max_z-min_z]
-
-    def classify_hand(self, side, palm_position, fingers):
-        fin_span = self.finger_span(fingers)
-        print("HAND POS: "+str(palm_position))
-        # print("FINGERS: "+str(fingers))
-        # print("FIN SPAN: "+str(fin_span))
+        # recent palm positions and velocity magnitudes of each hand, with the
+        # times they were sampled at. A hand's positions only count from the
+        # time it was last found (tracked_since), and not at all while it is
+        # not available
+        self.history_size = 50
+        self.hand_available = np.zeros(self.num_hands, dtype=bool)
+        self.tracked_since = np.full(self.num_hands, np.inf)
+        self.sample_times = RingBuffer(self.history_size, dtype=np.float64)
+        self.palm_pos_over_time = RingBuffer(self.history_size, dtype=np.float64, shape=(self.num_hands, 3))
+        self.palm_vel_over_time = RingBuffer(self.history_size, dtype=np.float64, shape=(self.num_hands,))
+
+        # time of the latest large acceleration of each hand's current
+        # cluster of them, or nan when there is no cluster
+        self.last_large_acc_time = np.full(self.num_hands, np.nan)
+
+        self.palm_velocity = np.zeros((self.num_hands, 3))
+        self.palm_acceleration = np.zeros(self.num_hands)
+
+        # packed hands of the latest leap_source frame
+        self.hands_record = np.zeros((self.num_hands, kHandRows, 3), dtype=np.float32)
+        self.valid_record = np.zeros((self.num_hands, kHandRows), dtype=bool)
+
+    # classifies the hand configuration of every hand in mask at once. palms
+    # and fin_spans are (num_hands, 3). Returns an index into GESTURES for
+    # each hand (NONE for hands not in mask), and starts the timeouts of the
+    # gestures that were recognized
+    def classify_hands(self, mask, palms, fin_spans):
+        for h in np.flatnonzero(mask):
+            print("HAND POS: "+str(palms[h]))
+
+        ready = self.gesture_timeouts <= 0.0
+        height = palms[:, 1]
+        span_x, span_y, span_z = fin_spans[:, 0], fin_spans[:, 1], fin_spans[:, 2]
 
         # classifying fist
-        if self.gesture_timeouts[side+"fist"] <= 0.0 and fin_span[0] < 55.0 and fin_span[1] < 45.0 and fin_span[2] < 45.0 and palm_position[1] > 130.0:
-            self.gesture_timeouts[side+"fist"] = 0.25
-            return "fist"
+        fist = mask & ready[:, FIST] & (span_x < 55.0) & (span_y < 45.0) & (span_z < 45.0) & (height > 130.0)
+        remaining = mask & ~fist
 
         # classifying upward conducting stroke
-        if self.gesture_timeouts[side+"up_conduct"] <= 0.0 and palm_position[1] > 250.0:
-            if fin_span[0] < 85.0:
-                self.gesture_timeouts[side+"up_conduct"] = 0.35
-                self.gesture_timeouts[side+"down_conduct"] = 0.15
-                return "up_conduct"
+        up = remaining & ready[:, UP_CONDUCT] & (height > 250.0) & (span_x < 85.0)
+        remaining &= ~up
 
         # classifying downward conducting stroke
-        if self.gesture_timeouts[side+"down_conduct"] <= 0.0 and palm_position[1] < 180.0:
-            if fin_span[0] < 85.0:
-                self.gesture_timeouts[side+"down_conduct"] = 0.35
-                self.gesture_timeouts[side+"up_conduct"] = 0.15
-                return "down_conduct"
+        down = remaining & ready[:, DOWN_CONDUCT] & (height < 180.0) & (span_x < 85.0)
+        remaining &= ~down
 
         # classifying piano stroke
-        if self.gesture_timeouts[side+"piano"] <= 0.0 and palm_position[1] < 240.0:
-            if fin_span[0] > 100.0 and fin_span[1] < 30.0 and fin_span[2] < 92.0:
-                self.gesture_timeouts[side+"piano"] = 0.25
-                return "piano"
-
-        return "none"
-
-    def gather_leap_data(self):
-        leap_frame = self.leap.frame()
-        left_palm, right_palm = leap_two_palms(leap_frame)
-        left_fingers = leap_fingers_frame(leap_frame, "left")
-        right_fingers = leap_fingers_frame(leap_frame, "right")
-        return left_palm, right_palm, left_fingers, right_fingers
+        piano = remaining & ready[:, PIANO] & (height < 240.0) & (span_x > 100.0) & (span_y < 30.0) & (span_z < 92.0)
+
+        self.gesture_timeouts[fist, FIST] = 0.25
+        self.gesture_timeouts[up, UP_CONDUCT] = 0.35
+        self.gesture_timeouts[up, DOWN_CONDUCT] = 0.15
+        self.gesture_timeouts[down, DOWN_CONDUCT] = 0.35
+        self.gesture_timeouts[down, UP_CONDUCT] = 0.15
+        self.gesture_timeouts[piano, PIANO] = 0.25
+
+        classifications = np.full(self.num_hands, NONE)
+        classifications[fist] = FIST
+        classifications[up] = UP_CONDUCT
+        classifications[down] = DOWN_CONDUCT
+        classifications[piano] = PIANO
+        return classifications
 
     def on_update(self, dt=0.1) :
+        # leap_source frames are processed by on_leap_frame as they are replayed
+        if self.leap_source != None:
+            return
+
+        # processes every Leap frame captured since the last update, each
+        # with the time that passed since the frame before it
+        times, hands, valid = self.leap_capture.read_frames()
+        if len(times) == 0:
+            return
+        wall_clock_offset = time.time() - times[-1]
+        for i in range(len(times)):
+            frame_dt = 0.0 if self.last_frame_time == None else times[i] - self.last_frame_time
+            self.last_frame_time = times[i]
+
+            if self.recorder != None:
+                self.recorder.record_leap(hands[i, 0, 0], hands[i, 1, 0],
+                                          hands[i, 0, 1:][valid[i, 0, 1:]], hands[i, 1, 1:][valid[i, 1, 1:]],
+                                          times[i] + wall_clock_offset)
+            self.process_frame(frame_dt, hands[i], valid[i])
+
+    # leap_source listener, called once per replayed Leap frame with the
+    # inputs of leaputil.pack_hands. Frames are timed by their recorded
+    # timestamps, the same way on_update times live frames
+    def on_leap_frame(self, left_palm, right_palm, left_fingers, right_fingers):
+        frame_time = self.leap_source.leap_frame_time
+        frame_dt = 0.0 if self.last_frame_time == None else frame_time - self.last_frame_time
+        self.last_frame_time = frame_time
+
+        pack_hands(left_palm, right_palm, left_fingers, right_fingers, hands = self.hands_record, valid = self.valid_record)
+        self.process_frame(frame_dt, self.hands_record, self.valid_record)
+
+    # runs one frame of Leap data, dt seconds after the previous one, through
+    # the recognizer. hands and valid are packed as leaputil.pack_hands does
+    def process_frame(self, dt, hands, valid):
         self.t += dt
 
         # time management
-        for key in self.gesture_timeouts.keys():
-            self.gesture_timeouts[key] = max(self.gesture_timeouts[key]-dt, 0.0)
+        self.gesture_timeouts = np.maximum(self.gesture_timeouts - dt, 0.0)
 
-        # gathering raw data from the Leap
-        left_palm, right_palm, left_fingers, right_fingers = self.gather_leap_data()
+        palms = hands[:, 0].astype(np.float64)
+        available = np.any(valid[:, 1:], axis=1)
 
-        if len(left_fingers) == 0:
-            self.left_hand_available = False
-            self.left_palm_pos_over_time = []
-        else:
-            self.left_hand_available = True
-
-            # stores palm positions over time
-            self.left_palm_pos_over_time.append( (left_palm, self.t) )
-            if len(self.left_palm_pos_over_time) > 50:
-                self.left_palm_pos_over_time = self.left_palm_pos_over_time[1:]
-
-        if len(right_fingers) == 0:
-            self.right_hand_available = False
-            self.right_palm_pos_over_time = []
-        else:
-            self.right_hand_available = True
-
-            # stores palm positions over time
-            self.right_palm_pos_over_time.append( (right_palm, self.t) )
-            if len(self.right_palm_pos_over_time) > 50:
-                self.right_palm_pos_over_time = self.right_palm_pos_over_time[1:]
+        # stores palm positions over time
+        self.tracked_since[available & ~self.hand_available] = self.t
+        self.tracked_since[~available] = np.inf
+        self.hand_available = available
+        self.sample_times.append(self.t)
+        self.palm_pos_over_time.append(palms)
+        times = self.sample_times.latest(self.history_size)
 
         # calculates velocities of each palm position
-        self.left_palm_velocity = np.array((0.0, 0.0, 0.0))
-        left_palm_valid_sample_count = 0
-        for j in range(len(self.left_palm_pos_over_time)):
-            i = len(self.left_palm_pos_over_time)-j-1
-            if self.left_palm_pos_over_time[i][1] >= self.t-self.speed_timespan:
-                sample = self.left_palm_pos_over_time[i]
-                self.left_palm_velocity += (left_palm-sample[0])/(self.t-sample[1]+0.00001)
-                left_palm_valid_sample_count += 1
-            else:
-                break
-        self.left_palm_velocity = self.left_palm_velocity / max(left_palm_valid_sample_count, 1)
-
-        self.right_palm_velocity = np.array((0.0, 0.0, 0.0))
-        right_palm_valid_sample_count = 0
-        for j in range(len(self.right_palm_pos_over_time)):
-            i = len(self.right_palm_pos_over_time)-j-1
-            if self.right_palm_pos_over_time[i][1] >= self.t-self.speed_timespan:
-                sample = self.right_palm_pos_over_time[i]
-                self.right_palm_velocity += (right_palm-sample[0])/(self.t-sample[1]+0.00001)
-                right_palm_valid_sample_count += 1
-            else:
-                break
-        self.right_palm_velocity = self.right_palm_velocity / max(right_palm_valid_sample_count, 1)
-        
-        left_palm_velocty_magnitude = np.linalg.norm(self.left_palm_velocity)
-        right_palm_velocty_magnitude = np.linalg.norm(self.right_palm_velocity)
+        self.palm_velocity = windowed_rate(self.palm_pos_over_time.latest(self.history_size), times,
+                                           palms, self.t, self.speed_timespan, self.tracked_since)
+        palm_velocity_magnitude = np.sqrt(np.sum(self.palm_velocity * self.palm_velocity, axis=1))
 
         # calculates acceleration of each palm position using velocity magnitude
-        self.left_palm_vel_over_time.append( (left_palm_velocty_magnitude, self.t) )
-        if len(self.left_palm_vel_over_time) > 50:
-            self.left_palm_vel_over_time = self.left_palm_vel_over_time[1:]
-        self.right_palm_vel_over_time.append( (right_palm_velocty_magnitude, self.t) )
-        if len(self.right_palm_vel_over_time) > 50:
-            self.right_palm_vel_over_time = self.right_palm_vel_over_time[1:]
-
-        self.left_palm_acceleration = 0.0
-        left_palm_valid_sample_count = 0
-        for j in range(len(self.left_palm_vel_over_time)):
-            i = len(self.left_palm_vel_over_time)-j-1
-            if self.left_palm_vel_over_time[i][1] >= self.t-self.acceleration_timespan:
-                sample = self.left_palm_vel_over_time[i]
-                self.left_palm_acceleration += (left_palm_velocty_magnitude-sample[0])/(self.t-sample[1]+0.00001)
-                left_palm_valid_sample_count += 1
-            else:
-                break
-        self.left_palm_acceleration = self.left_palm_acceleration / max(left_palm_valid_sample_count, 1)
-
-        self.right_palm_acceleration = 0.0
-        right_palm_valid_sample_count = 0
-        for j in range(len(self.right_palm_vel_over_time)):
-            i = len(self.right_palm_vel_over_time)-j-1
-            if self.right_palm_vel_over_time[i][1] >= self.t-self.acceleration_timespan:
-                sample = self.right_palm_vel_over_time[i]
-                self.right_palm_acceleration += (right_palm_velocty_magnitude-sample[0])/(self.t-sample[1]+0.00001)
-                right_palm_valid_sample_count += 1
-            else:
-                break
-        self.right_palm_acceleration = self.right_palm_acceleration / max(right_palm_valid_sample_count, 1)
+        self.palm_vel_over_time.append(palm_velocity_magnitude)
+        self.palm_acceleration = windowed_rate(self.palm_vel_over_time.latest(self.history_size), times,
+                                               palm_velocity_magnitude, self.t, self.acceleration_timespan)
 
-        # print("ACC: "+str(self.left_palm_acceleration)+", "+str(self.right_palm_acceleration))
+        # print("ACC: "+str(self.palm_acceleration))
 
         # if large acceleration occurs, track clustered acceleration points
-        if self.left_hand_available == True:
-            if np.abs(self.left_palm_acceleration) > self.acceleration_threshold:
-                self.clustered_left_palm_acc.append( (self.left_palm_acceleration, self.t) )
-            elif np.abs(self.left_palm_acceleration) < self.acceleration_stop_threshold and len(self.clustered_left_palm_acc) > 0 and np.abs(self.clustered_left_palm_acc[-1][1] - self.t) > self.acceleration_stop_timespan:
-                self.clustered_left_palm_acc = []
-
-                # if large acceleration stops, quantize beat and classify hand configuration
-                hand_classification = self.classify_hand("left", left_palm, left_fingers)
-                quantized_beat = self.quantize_func(self.t)
-                if hand_classification != "none":
-                    print("LARGE LEFT ACC: "+str(self.t)+", C: "+str(hand_classification)+", QB: "+str(quantized_beat))
-
-                    if hand_classification == "up_conduct":
-                        self.play_func()
-                        self.tempo_processor.add_sample(self.t, "up")
-                        new_tempo = self.tempo_processor.estimate_tempo(self.tempo_map.bpm)
-                        if new_tempo != None:
-                            print("NEW TEMPO: "+str(new_tempo))
-                            self.tempo_map.set_tempo(new_tempo, self.t)
-                    elif hand_classification == "down_conduct":
-                        self.play_func()
-                        self.tempo_processor.add_sample(self.t, "down")
-                        new_tempo = self.tempo_processor.estimate_tempo(self.tempo_map.bpm)
-                        if new_tempo != None:
-                            print("NEW TEMPO: "+str(new_tempo))
-                            self.tempo_map.set_tempo(new_tempo, self.t)
-                    elif hand_classification == "piano":
-                        self.play_func("piano")
-                    elif hand_classification == "fist":
-                        self.play_func("drums")
-
-                else:
-                    print("LARGE UNRECOGNIZED LEFT ACC: "+str(self.t))
-
-        if self.right_hand_available == True:
-            if np.abs(self.right_palm_acceleration) > self.acceleration_threshold:
-                self.clustered_right_palm_acc.append( (self.right_palm_acceleration, self.t) )
-            elif np.abs(self.right_palm_acceleration) < self.acceleration_stop_threshold and len(self.clustered_right_palm_acc) > 0 and np.abs(self.clustered_right_palm_acc[-1][1] - self.t) > self.acceleration_stop_timespan:
-                self.clustered_right_palm_acc = []
-
-                # if large acceleration stops, quantize beat and classify hand configuration
-                hand_classification = self.classify_hand("right", right_palm, right_fingers)
-                quantized_beat = self.quantize_func(self.t)
-                if hand_classification != "none":
-                    print("LARGE RIGHT ACC: "+str(self.t)+", C: "+str(hand_classification)+", QB: "+str(quantized_beat))
-
-                    if hand_classification == "up_conduct":
-                        self.play_func()
-                        self.tempo_processor.add_sample(self.t, "up")
-                        new_tempo = self.tempo_processor.estimate_tempo(self.tempo_map.bpm)
-                        if new_tempo != None:
-                            print("NEW TEMPO: "+str(new_tempo))
-                            self.tempo_map.set_tempo(new_tempo, self.t)
-                    elif hand_classification == "down_conduct":
-                        self.play_func()
-                        self.tempo_processor.add_sample(self.t, "down")
-                        new_tempo = self.tempo_processor.estimate_tempo(self.tempo_map.bpm)
-                        if new_tempo != None:
-                            print("NEW TEMPO: "+str(new_tempo))
-                            self.tempo_map.set_tempo(new_tempo, self.t)
-                    elif hand_classification == "piano":
-                        self.play_func("piano")
-                    elif hand_classification == "fist":
-                        self.play_func("drums")
-
-                else:
-                    print("LARGE UNRECOGNIZED RIGHT ACC: "+str(self.t))
-        
-
-
+        abs_acceleration = np.abs(self.palm_acceleration)
+        large = available & (abs_acceleration > self.acceleration_threshold)
+        stopped = available & ~large & (abs_acceleration < self.acceleration_stop_threshold) & \
+                  (np.abs(self.last_large_acc_time - self.t) > self.acceleration_stop_timespan)
+        self.last_large_acc_time[large] = self.t
+        self.last_large_acc_time[stopped] = np.nan
+        if not np.any(stopped):
+            return
+
+        # if large acceleration stops, quantize beat and classify hand configuration
+        fin_spans = np.ptp(hands[:, 1:], axis=1)
+        classifications = self.classify_hands(stopped, palms, fin_spans)
+        quantized_beat = self.quantize_func(self.t)
+
+        for h in np.flatnonzero(stopped):
+            side = HAND_SIDES[h].upper()
+            hand_classification = GESTURES[classifications[h]]
+            if hand_classification != "none":
+                print("LARGE "+side+" ACC: "+str(self.t)+", C: "+str(hand_classification)+", QB: "+str(quantized_beat))
+
+                if hand_classification == "up_conduct":
+                    self.play_func()
+                    self.tempo_processor.add_sample(self.t, "up")
+                    new_tempo = self.tempo_processor.estimate_tempo(self.tempo_map.bpm)
+                    if new_tempo != None:
+                        print("NEW TEMPO: "+str(new_tempo))
+                        self.tempo_map.set_tempo(new_tempo, self.t)
+                elif hand_classification == "down_conduct":
+                    self.play_func()
+                    self.tempo_processor.add_sample(self.t, "down")
+                    new_tempo = self.tempo_processor.estimate_tempo(self.tempo_map.bpm)
+                    if new_tempo != None:
+                        print("NEW TEMPO: "+str(new_tempo))
+                        self.tempo_map.set_tempo(new_tempo, self.t)
+                elif hand_classification == "piano":
+                    self.play_func("piano")
+                elif hand_classification == "fist":
+                    self.play_func("drums")
 
+            else:
+                print("LARGE UNRECOGNIZED "+side+" ACC: "+str(self.t))
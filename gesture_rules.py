@@ -0,0 +1,257 @@
+import numpy as np
+from kinect import NUM_JOINTS, joint_index
+from kinect import BEAT_RIGHT, BEAT_UP, BEAT_BACK, BEAT_LEFT, BEAT_DOWN, BEAT_FRONT
+
+# Declarative gesture rules over the joint arrays of a SkeletonModel.
+#
+# A rule's condition is built from linear expressions of per-frame features
+# (joint positions and velocities, beat flags, and named variables supplied
+# by the caller), compared against constants and combined with & and |:
+#
+#     (pos(JointId.HandRight).y - pos(JointId.HipCenter).y > 0.2) & beat(JointId.HandRight, "front")
+#
+# Each rule set compiles all comparisons of all its rules into one matrix, so
+# a frame is evaluated with a few matrix products no matter how many rules
+# there are. Only the actions of the rules that fire run in Python.
+
+BEAT_DIRECTIONS = {"right": BEAT_RIGHT, "up": BEAT_UP, "back": BEAT_BACK,
+                   "left": BEAT_LEFT, "down": BEAT_DOWN, "front": BEAT_FRONT}
+
+# first feature column of each of the SkeletonModel's joint arrays
+kPosColumn = 0
+kVelColumn = kPosColumn + NUM_JOINTS * 3
+kBeatColumn = kVelColumn + NUM_JOINTS * 3
+kOngoingColumn = kBeatColumn + NUM_JOINTS * len(BEAT_DIRECTIONS)
+kNumJointFeatures = kOngoingColumn + NUM_JOINTS
+
+# linear combination of features, as a dict of feature key -> coefficient
+class Linear(object):
+    def __init__(self, coefs):
+        self.coefs = coefs
+
+    def _combine(self, other, sign):
+        coefs = dict(self.coefs)
+        for key, coef in other.coefs.items():
+            coefs[key] = coefs.get(key, 0.0) + sign * coef
+        return Linear(coefs)
+
+    def __add__(self, other):
+        return self._combine(other, 1.0)
+
+    def __sub__(self, other):
+        return self._combine(other, -1.0)
+
+    def __neg__(self):
+        return self * -1.0
+
+    def __mul__(self, scale):
+        return Linear(dict((key, coef * scale) for key, coef in self.coefs.items()))
+
+    def __truediv__(self, scale):
+        return self * (1.0 / scale)
+    __div__ = __truediv__
+
+    def __lt__(self, threshold):
+        return Comparison(self, threshold)
+
+    def __gt__(self, threshold):
+        return Comparison(-self, -threshold)
+
+    def __abs__(self):
+        return Abs(self)
+
+class Abs(object):
+    def __init__(self, linear):
+        self.linear = linear
+
+    def __lt__(self, threshold):
+        return (self.linear < threshold) & (self.linear > -threshold)
+
+    def __gt__(self, threshold):
+        return (self.linear > threshold) | (self.linear < -threshold)
+
+class Condition(object):
+    def __and__(self, other):
+        return All(self, other)
+
+    def __or__(self, other):
+        return Any(self, other)
+
+# linear < threshold
+class Comparison(Condition):
+    def __init__(self, linear, threshold):
+        self.linear = linear
+        self.threshold = threshold
+
+    def clauses(self):
+        return [[self]]
+
+class All(Condition):
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    # the condition in disjunctive normal form: a list of clauses, each a
+    # list of comparisons that must all hold
+    def clauses(self):
+        result = [[]]
+        for condition in self.conditions:
+            result = [a + b for a in result for b in condition.clauses()]
+        return result
+
+class Any(Condition):
+    def __init__(self, *conditions):
+        self.conditions = conditions
+
+    def clauses(self):
+        return [clause for condition in self.conditions for clause in condition.clauses()]
+
+class Vec3(object):
+    def __init__(self, kind, joint):
+        j = joint_index(joint)
+        self.x = Linear({(kind, j, 0): 1.0})
+        self.y = Linear({(kind, j, 1): 1.0})
+        self.z = Linear({(kind, j, 2): 1.0})
+
+def pos(joint):
+    return Vec3("pos", joint)
+
+def vel(joint):
+    return Vec3("vel", joint)
+
+# the joint had a beat this frame in the given direction ("up", "down",
+# "left", "right", "front" or "back")
+def beat(joint, direction):
+    return Linear({("beat", joint_index(joint), BEAT_DIRECTIONS[direction]): 1.0}) > 0.5
+
+# the joint is in the middle of a beat stroke
+def ongoing_beat(joint):
+    return Linear({("ongoing", joint_index(joint)): 1.0}) > 0.5
+
+# a value the caller passes to update() each frame, in its variables dict
+def var(name):
+    return Linear({("var", name): 1.0})
+
+
+# A named gesture. Rules are tried in order of priority (lowest first). When
+# an exclusive rule fires, no lower priority rule fires that frame. A rule
+# with a cooldown only fires once at least cooldown frames have passed since
+# it last fired (or since its phase was entered). action (if any) is called
+# with no arguments when the rule fires.
+class GestureRule(object):
+    def __init__(self, name, condition, action = None, priority = 0, exclusive = False, cooldown = 0):
+        self.name = name
+        self.condition = condition
+        self.action = action
+        self.priority = priority
+        self.exclusive = exclusive
+        self.cooldown = cooldown
+
+
+class GestureRuleSet(object):
+    def __init__(self, rules):
+        self.rules = sorted(rules, key = lambda rule: rule.priority)
+
+        comparisons = []
+        clause_rules = []
+        clauses = []
+        for r, rule in enumerate(self.rules):
+            for clause in rule.condition.clauses():
+                clauses.append([len(comparisons) + i for i in range(len(clause))])
+                comparisons.extend(clause)
+                clause_rules.append(r)
+
+        # feature columns: the joint arrays of the skeleton model (see
+        # _column), then one column per named variable
+        self.var_columns = {}
+        for comparison in comparisons:
+            for key in comparison.linear.coefs:
+                if key[0] == "var" and key[1] not in self.var_columns:
+                    self.var_columns[key[1]] = kNumJointFeatures + len(self.var_columns)
+        self.features = np.zeros(kNumJointFeatures + len(self.var_columns))
+
+        # comparison matrix: comparison i holds when coefs[i] . features < thresholds[i]
+        self.coefs = np.zeros((len(comparisons), len(self.features)))
+        self.thresholds = np.array([c.threshold for c in comparisons], dtype=np.float64)
+        for i, comparison in enumerate(comparisons):
+            for key, coef in comparison.linear.coefs.items():
+                self.coefs[i, self._column(key)] += coef
+
+        # clause matrix: a clause holds when all of its comparisons do, and a
+        # rule matches when any of its clauses holds
+        self.clause_comparisons = np.zeros((len(clauses), len(comparisons)))
+        for c, clause in enumerate(clauses):
+            self.clause_comparisons[c, clause] = 1
+        self.clause_sizes = np.sum(self.clause_comparisons, axis=1)
+        self.rule_clauses = np.zeros((len(self.rules), len(clauses)))
+        self.rule_clauses[clause_rules, np.arange(len(clauses))] = 1
+
+        self.cooldowns = np.array([rule.cooldown for rule in self.rules])
+        self.frames_since_fired = np.zeros(len(self.rules))
+
+    def _column(self, key):
+        kind = key[0]
+        if kind == "pos":
+            return kPosColumn + key[1] * 3 + key[2]
+        if kind == "vel":
+            return kVelColumn + key[1] * 3 + key[2]
+        if kind == "beat":
+            return kBeatColumn + key[1] * len(BEAT_DIRECTIONS) + key[2]
+        if kind == "ongoing":
+            return kOngoingColumn + key[1]
+        return self.var_columns[key[1]]
+
+    def reset(self):
+        self.frames_since_fired[:] = 0
+
+    # returns a bool array of which rules' conditions hold for the skeleton
+    # model's current frame
+    def match(self, skeleton_model, variables = {}):
+        self.features[kPosColumn:kVelColumn] = skeleton_model.pos.ravel()
+        self.features[kVelColumn:kBeatColumn] = skeleton_model.vel.ravel()
+        self.features[kBeatColumn:kOngoingColumn] = skeleton_model.beat_dirs.ravel()
+        self.features[kOngoingColumn:kNumJointFeatures] = skeleton_model.has_ongoing_beat
+        for name, column in self.var_columns.items():
+            self.features[column] = variables[name]
+
+        comparisons = self.coefs.dot(self.features) < self.thresholds
+        clauses = self.clause_comparisons.dot(comparisons) == self.clause_sizes
+        return self.rule_clauses.dot(clauses) > 0
+
+    # fires the rules that match and are off cooldown, in priority order, and
+    # returns the names of the rules that fired
+    def update(self, skeleton_model, variables = {}):
+        candidates = self.match(skeleton_model, variables) & (self.frames_since_fired >= self.cooldowns)
+        self.frames_since_fired += 1
+
+        fired = []
+        for r in np.flatnonzero(candidates):
+            rule = self.rules[r]
+            self.frames_since_fired[r] = 0
+            fired.append(rule.name)
+            if rule.action:
+                rule.action()
+            if rule.exclusive:
+                break
+        return fired
+
+
+# Keeps one GestureRuleSet per phase, and evaluates the current phase's
+# rules. Cooldowns restart whenever a phase is entered.
+class GestureRuleEngine(object):
+    def __init__(self, rules_by_phase, phase = 0):
+        self.rule_sets = dict((p, GestureRuleSet(rules)) for p, rules in rules_by_phase.items())
+        self.phase = phase
+        self.last_fired = []
+
+    def set_phase(self, phase):
+        if phase != self.phase and phase in self.rule_sets:
+            self.rule_sets[phase].reset()
+        self.phase = phase
+
+    def update(self, skeleton_model, variables = {}):
+        rule_set = self.rule_sets.get(self.phase)
+        if rule_set == None:
+            self.last_fired = []
+        else:
+            self.last_fired = rule_set.update(skeleton_model, variables)
+        return self.last_fired
@@ -4,7 +4,8 @@ import thread
 import itertools
 import ctypes
 import sys
-from threading import Timer
+import threading
+from collections import deque
 import time
 import math
 import numpy as np
@@ -23,6 +24,10 @@ DEPTH_WINSIZE = 640,480
 VIDEO_WINSIZE = 640,480
 SAMPLE_RATE = 30
 
+# max number of skeleton frames that can wait for the consumer. When the queue
+# is full, the oldest frame is dropped
+kMaxQueuedFrames = 8
+
 SKELETON_COLORS = [THECOLORS["red"], 
                    THECOLORS["blue"], 
                    THECOLORS["green"], 
@@ -83,6 +88,9 @@ def surface_to_array(surface):
    return bytes
 
 
+# Skeleton frames are captured on a long-lived thread and pushed, with the
+# time they were captured, onto a bounded queue. Listeners are only called
+# from on_update(), on whichever thread drives it (normally the UI thread).
 class Kinect:
 
     def __init__(self, display=0, draw_skeleton=False, elevation_angle=20):
@@ -92,6 +100,16 @@ class Kinect:
         self.elevation_angle = elevation_angle
         self.listeners = []
 
+        # deque append / popleft are atomic, so the capture thread and the
+        # consumer can share it without a lock
+        self.frames = deque(maxlen = kMaxQueuedFrames)
+        self.num_captured_frames = 0
+        self.num_dropped_frames = 0
+        self.frame_time = None # capture time of the frame being delivered to listeners
+
+        self.capture_thread = None
+        self.capturing = False
+
     def add_listener(self, callback):
         self.listeners.append(callback)
 
@@ -102,12 +120,12 @@ class Kinect:
         self.kinect.camera.elevation_angle = self.elevation_angle
 
         self.kinect.skeleton_engine.enabled = True
+        self.skeletons = None
 
         if self.video_display or self.depth_display:
             self.screen_lock = thread.allocate()
             self.screen = pygame.display.set_mode(VIDEO_WINSIZE if self.video_display else DEPTH_WINSIZE, 0, 32 if self.video_display else 16)
             pygame.display.set_caption('PyKinect')
-            self.skeletons = None
             self.screen.fill(THECOLORS["black"])
             
             if self.video_display:
@@ -121,27 +139,54 @@ class Kinect:
 
         self.dispInfo = pygame.display.Info()
 
-        self.update_skeleton()
-
-    def update_skeleton(self):
-        try:
-            self.skeletons = self.kinect.skeleton_engine.get_next_frame().SkeletonData
-        except:
+        self.capturing = True
+        self.capture_thread = threading.Thread(target = self._capture_skeletons)
+        self.capture_thread.daemon = True
+        self.capture_thread.start()
+
+    def stop(self):
+        self.capturing = False
+        if self.capture_thread:
+            self.capture_thread.join()
+            self.capture_thread = None
+
+    # runs on the capture thread. get_next_frame blocks until the Kinect has
+    # a new frame (or times out), so this loop runs at the sensor's rate
+    def _capture_skeletons(self):
+        while self.capturing:
+            try:
+                skeletons = self.kinect.skeleton_engine.get_next_frame(100).SkeletonData
+            except:
+                time.sleep(.01)
+                continue
+            t = time.time()
+
+            try:
+                skeleton = next(skeleton.SkeletonPositions for skeleton in skeletons if skeleton.eTrackingState == SkeletonTrackingState.TRACKED)
+            except:
+                skeleton = None
+
+            if len(self.frames) == self.frames.maxlen:
+                self.num_dropped_frames += 1
+            self.frames.append( (t, skeleton) )
+            self.skeletons = skeletons
+            self.num_captured_frames += 1
+
+    # delivers all queued skeleton frames to the listeners, oldest first.
+    # Call this regularly from the thread that owns the listeners' state
+    def on_update(self):
+        if not self.frames:
             return
 
-        try:
-            skeleton = next(skeleton.SkeletonPositions for skeleton in self.skeletons if skeleton.eTrackingState == SkeletonTrackingState.TRACKED)
-        except:
-            skeleton = None
+        while self.frames:
+            self.frame_time, skeleton = self.frames.popleft()
+            for listener in self.listeners:
+                listener(skeleton)
 
-        for listener in self.listeners:
-            listener(skeleton)
-
-        if self.draw_skeleton:
-            self.draw_skeletons(self.skeletons)
-            pygame.display.update()
-
-        Timer(.01, self.update_skeleton).start()
+        if self.draw_skeleton and self.skeletons is not None and (self.video_display or self.depth_display):
+            with self.screen_lock:
+                self.draw_skeletons(self.skeletons)
+                pygame.display.update()
 
     def draw_skeleton_data(self, pSkelton, index, positions, width = 4):
         start = pSkelton.SkeletonPositions[positions[0]]
@@ -222,94 +267,167 @@ class Beat:
         self.pos = pos
         self.vel = vel
 
+NUM_JOINTS = 20 # joints in a Kinect skeleton, indexed by JointId
+
+# column of SkeletonModel.beat_dirs for each beat direction. Columns 0-2 are
+# the +x/+y/+z axes and 3-5 the -x/-y/-z axes
+BEAT_RIGHT, BEAT_UP, BEAT_BACK, BEAT_LEFT, BEAT_DOWN, BEAT_FRONT = range(6)
+
+def joint_index(joint):
+    return getattr(joint, 'value', joint)
+
+# returns the joint positions of a skeleton as a (NUM_JOINTS, 3) array. pykinect
+# stores SkeletonPositions as a ctypes array of (x, y, z, w) floats, which is
+# read without copying, and replayed skeletons carry their positions array.
+# Anything else is read joint by joint.
+def skeleton_to_array(skeleton):
+    positions = getattr(skeleton, 'positions', None)
+    if positions is not None:
+        return positions
+    try:
+        return np.frombuffer(skeleton, dtype=np.float32).reshape(NUM_JOINTS, 4)[:, :3]
+    except (TypeError, ValueError, AttributeError):
+        return np.array([[skeleton[j].x, skeleton[j].y, skeleton[j].z] for j in range(NUM_JOINTS)])
+
+# view of a single joint of a SkeletonModel
 class JointModel:
-    def __init__(self):
-        self.alpha_vel = 0.8
-        self.alpha_acc = 0.8
-        self.alpha_recent_vel = 0.4
-        self.beat_vel_thresh = 0.1
-        self.beat_acc_ratio_thresh = 0.8
-        
-        self.pos = None
-        self.vel = None
-        self.acc = None
-        self.recent_vel = None
-        
-        self.beat = None
-        self.ongoing_beat_vel = None
-
-    def update(self, pos):
-        if pos is None:
-            vel = None
-            acc = None
-            recent_vel = None
-        elif self.pos is None:
-            pos = np.array([pos.x, pos.y, pos.z])
-            vel = np.zeros(3)
-            acc = np.zeros(3)
-            recent_vel = np.zeros(3)
-        else:
-            pos = np.array([pos.x, pos.y, pos.z])
-            vel = self.alpha_vel * SAMPLE_RATE * (pos - self.pos) + (1 - self.alpha_vel) * self.vel
-            acc = self.alpha_acc * SAMPLE_RATE * (vel - self.vel) + (1 - self.alpha_acc) * self.acc
-            recent_vel = self.alpha_recent_vel * vel + (1 - self.alpha_recent_vel) * self.recent_vel
-
-        if self.recent_vel is not None and acc is not None and \
-                np.linalg.norm(self.recent_vel) > self.beat_vel_thresh and \
-                np.dot(vel - self.recent_vel, -unit_vector(self.recent_vel)) > self.beat_acc_ratio_thresh * np.linalg.norm(self.recent_vel):
-            if self.ongoing_beat_vel is None or angle(self.recent_vel, self.ongoing_beat_vel) > math.pi / 2:
-                self.beat = Beat(pos, self.recent_vel)
-            else:
-                self.beat = None
-            self.ongoing_beat_vel = self.recent_vel
-        else:
-            self.beat = self.ongoing_beat_vel = None
-
-        self.pos, self.vel, self.acc, self.recent_vel = pos, vel, acc, recent_vel
+    def __init__(self, skeleton_model, index):
+        self.model = skeleton_model
+        self.index = index
+
+    @property
+    def pos(self):
+        return self.model.pos[self.index] if self.model.tracked else None
+
+    @property
+    def vel(self):
+        return self.model.vel[self.index] if self.model.tracked else None
+
+    @property
+    def acc(self):
+        return self.model.acc[self.index] if self.model.tracked else None
+
+    @property
+    def recent_vel(self):
+        return self.model.recent_vel[self.index] if self.model.tracked else None
+
+    @property
+    def beat(self):
+        if not self.model.has_beat[self.index]:
+            return None
+        return Beat(self.model.beat_pos[self.index].copy(), self.model.beat_vel[self.index].copy())
+
+    @property
+    def ongoing_beat_vel(self):
+        if not self.model.has_ongoing_beat[self.index]:
+            return None
+        return self.model.ongoing_beat_vel[self.index].copy()
 
     def downbeat(self):
-        return self.beat is not None and -self.beat.vel[1] >= np.max(np.abs(self.beat.vel))
+        return self.model.beat_dirs[self.index, BEAT_DOWN]
 
     def upbeat(self):
-        return self.beat is not None and self.beat.vel[1] >= np.max(np.abs(self.beat.vel))
+        return self.model.beat_dirs[self.index, BEAT_UP]
 
     def rightbeat(self):
-        return self.beat is not None and self.beat.vel[0] >= np.max(np.abs(self.beat.vel))
+        return self.model.beat_dirs[self.index, BEAT_RIGHT]
 
     def leftbeat(self):
-        return self.beat is not None and -self.beat.vel[0] >= np.max(np.abs(self.beat.vel))
+        return self.model.beat_dirs[self.index, BEAT_LEFT]
 
     def frontbeat(self):
-        return self.beat is not None and -self.beat.vel[2] >= np.max(np.abs(self.beat.vel))
+        return self.model.beat_dirs[self.index, BEAT_FRONT]
 
     def backbeat(self):
-        return self.beat is not None and self.beat.vel[2] >= np.max(np.abs(self.beat.vel))
+        return self.model.beat_dirs[self.index, BEAT_BACK]
 
     def active(self):
-        return (self.vel is not None and np.linalg.norm(self.vel) > 0.2) or (self.recent_vel is not None and np.linalg.norm(self.recent_vel) > 0.2)
+        return self.model.active[self.index]
 
 
-TRACKED_JOINTS = [JointId.HandRight, JointId.HandLeft]
-
+# Kinematics and beat detection for every joint of a skeleton. The state of
+# all joints is kept in (NUM_JOINTS, 3) arrays and updated with one set of
+# vectorized operations per frame. skeleton_model[joint] returns a JointModel
+# view of a single joint.
 class SkeletonModel:
     def __init__(self):
-        self.joints = {}
-        for joint in TRACKED_JOINTS:
-            self[joint] = JointModel()
+        self.alpha_vel = 0.8
+        self.alpha_acc = 0.8
+        self.alpha_recent_vel = 0.4
+        self.beat_vel_thresh = 0.1
+        self.beat_acc_ratio_thresh = 0.8
+        self.active_thresh = 0.2
+
+        self.tracked = False # False until a skeleton is seen, and after it is lost
+        self.pos = np.zeros((NUM_JOINTS, 3))
+        self.vel = np.zeros((NUM_JOINTS, 3))
+        self.acc = np.zeros((NUM_JOINTS, 3))
+        self.recent_vel = np.zeros((NUM_JOINTS, 3))
+
+        self.has_beat = np.zeros(NUM_JOINTS, dtype=bool)
+        self.beat_pos = np.zeros((NUM_JOINTS, 3))
+        self.beat_vel = np.zeros((NUM_JOINTS, 3))
+        self.beat_dirs = np.zeros((NUM_JOINTS, 6), dtype=bool)
+        self.has_ongoing_beat = np.zeros(NUM_JOINTS, dtype=bool)
+        self.ongoing_beat_vel = np.zeros((NUM_JOINTS, 3))
+        self.active = np.zeros(NUM_JOINTS, dtype=bool)
 
-    def __getitem__(self, index):
-        return self.joints[index]
+        self.joints = [JointModel(self, j) for j in range(NUM_JOINTS)]
 
-    def __setitem__(self, index, value):
-        self.joints[index] = value
+    def __getitem__(self, joint):
+        return self.joints[joint_index(joint)]
 
     def update(self, skeleton):
         if skeleton is None:
-            for joint in TRACKED_JOINTS:
-                self[joint].update(None)
-        else:
-            for joint in TRACKED_JOINTS:
-                self[joint].update(skeleton[joint])
+            self.tracked = False
+            self.has_beat[:] = False
+            self.beat_dirs[:] = False
+            self.has_ongoing_beat[:] = False
+            self.active[:] = False
+            return
+
+        pos = skeleton_to_array(skeleton)
+        if not self.tracked:
+            self.tracked = True
+            self.pos[:] = pos
+            self.vel[:] = 0
+            self.acc[:] = 0
+            self.recent_vel[:] = 0
+            self.has_beat[:] = False
+            self.beat_dirs[:] = False
+            self.has_ongoing_beat[:] = False
+            self.active[:] = False
+            return
+
+        prev_vel = self.vel
+        prev_recent_vel = self.recent_vel
+        vel = self.alpha_vel * SAMPLE_RATE * (pos - self.pos) + (1 - self.alpha_vel) * prev_vel
+        acc = self.alpha_acc * SAMPLE_RATE * (vel - prev_vel) + (1 - self.alpha_acc) * self.acc
+        recent_vel = self.alpha_recent_vel * vel + (1 - self.alpha_recent_vel) * prev_recent_vel
+
+        # a beat is a sharp deceleration against the recent direction of motion.
+        # It only counts once per stroke, unless the direction turns by more
+        # than 90 degrees from the stroke's ongoing beat
+        recent_speed = np.sqrt(np.einsum('ij,ij->i', prev_recent_vel, prev_recent_vel))
+        braking = -np.einsum('ij,ij->i', vel - prev_recent_vel, prev_recent_vel) / np.maximum(recent_speed, 1e-12)
+        decelerating = (recent_speed > self.beat_vel_thresh) & (braking > self.beat_acc_ratio_thresh * recent_speed)
+        turned = np.einsum('ij,ij->i', prev_recent_vel, self.ongoing_beat_vel) < 0
+        self.has_beat = decelerating & (~self.has_ongoing_beat | turned)
+        self.beat_pos[self.has_beat] = pos[self.has_beat]
+        self.beat_vel[self.has_beat] = prev_recent_vel[self.has_beat]
+        self.ongoing_beat_vel[decelerating] = prev_recent_vel[decelerating]
+        self.has_ongoing_beat = decelerating
+
+        # direction of each beat: the axis and sign of its largest velocity component
+        signed_beat_vel = np.concatenate((self.beat_vel, -self.beat_vel), axis=1)
+        self.beat_dirs = self.has_beat[:, np.newaxis] & (signed_beat_vel >= np.max(np.abs(self.beat_vel), axis=1)[:, np.newaxis])
+
+        speed = np.sqrt(np.einsum('ij,ij->i', vel, vel))
+        recent_speed = np.sqrt(np.einsum('ij,ij->i', recent_vel, recent_vel))
+        self.active = (speed > self.active_thresh) | (recent_speed > self.active_thresh)
+
+        self.pos[:] = pos
+        self.vel, self.acc, self.recent_vel = vel, acc, recent_vel
 
 
 ################################################
@@ -465,14 +583,11 @@ from common.gfxutil import *
 from common.clock import *
 from common.metro import *
 
+# the demo's audio, synth and scheduler are only set up when this file is run
+# as a script (see below), so that importing kinect doesn't open an audio
+# stream or load a SoundFont
 previous_note = None
 channel = 0
-audio = Audio(2)
-synth = Synth('sfx/FluidR3_GM.sf2')
-tempo_map  = SimpleTempoMap(1200)
-sched = AudioScheduler(tempo_map)
-audio.set_generator(sched)
-sched.set_generator(synth)
 
 def play_sound(instrument, vel):
     global previous_note
@@ -504,6 +619,13 @@ def play_sound(instrument, vel):
     previous_note = note
 
 if __name__ == '__main__':
+    audio = Audio(2)
+    synth = get_synth_pool().get_synth('sfx/FluidR3_GM.sf2')
+    tempo_map  = SimpleTempoMap(1200)
+    sched = AudioScheduler(tempo_map)
+    audio.set_generator(sched)
+    sched.set_generator(synth)
+
     fig, ax = plt.subplots(1, 1)
 
     kinect = Kinect(1, True)
@@ -511,4 +633,5 @@ if __name__ == '__main__':
     kinect.start()
 
     while True:
-        pass
+        kinect.on_update()
+        time.sleep(.005)
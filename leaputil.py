@@ -16,6 +16,7 @@ import sys
 import numpy as np
 import os
 import os.path
+from ring_buffer import RingBuffer
 
 common_dir_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -136,3 +137,111 @@ def leap_fingers_frame(frame, side="left"):
     fingers = hand.fingers
     return [pt_to_array(f.tip_position) for f in fingers]
 
+
+
+kMaxFingers = 5 # fingers per Leap hand
+kHandRows = 1 + kMaxFingers # palm, then finger tips
+
+# Packs the palm and finger tip positions of both hands into a (2, kHandRows, 3)
+# float32 array, with hand 0 = left and hand 1 = right, and row 0 the palm and
+# rows 1 on the finger tips. valid is a matching (2, kHandRows) bool array
+# telling which rows hold data. Missing finger rows repeat the hand's last
+# finger tip (or are 0 if it has none), so np.ptp over the finger rows always
+# gives the hand's finger span. hands and valid are filled in place if given.
+def pack_hands(left_palm, right_palm, left_fingers, right_fingers, hands = None, valid = None):
+    if hands is None:
+        hands = np.zeros((2, kHandRows, 3), dtype=np.float32)
+    if valid is None:
+        valid = np.zeros((2, kHandRows), dtype=bool)
+    hands[:] = 0
+    valid[:] = False
+
+    for side, (palm, fingers) in enumerate(((left_palm, left_fingers), (right_palm, right_fingers))):
+        num_fingers = min(len(fingers), kMaxFingers)
+        if num_fingers == 0:
+            continue
+        hands[side, 0] = palm
+        hands[side, 1:1 + num_fingers] = fingers[:num_fingers]
+        hands[side, 1 + num_fingers:] = hands[side, num_fingers]
+        valid[side, :1 + num_fingers] = True
+    return hands, valid
+
+
+# Same as pack_hands, straight from a Leap frame. Each of the (up to two)
+# hands in the frame goes in its own row by is_left.
+def leap_hands_array(frame, hands = None, valid = None):
+    if hands is None:
+        hands = np.zeros((2, kHandRows, 3), dtype=np.float32)
+    if valid is None:
+        valid = np.zeros((2, kHandRows), dtype=bool)
+    hands[:] = 0
+    valid[:] = False
+
+    for hand in list(frame.hands)[:2]:
+        side = 0 if hand.is_left else 1
+        if valid[side, 0]:
+            continue
+        tips = [f.tip_position.to_float_array() for f in hand.fingers][:kMaxFingers]
+        if len(tips) == 0:
+            continue
+        num_fingers = len(tips)
+        hands[side, 0] = hand.palm_position.to_float_array()
+        hands[side, 1:1 + num_fingers] = tips
+        hands[side, 1 + num_fingers:] = hands[side, num_fingers]
+        valid[side, :1 + num_fingers] = True
+    return hands, valid
+
+
+# Captures every Leap frame as it arrives, on the Leap service's own thread.
+# Each frame is converted once with leap_hands_array into preallocated arrays
+# and timestamped with the device's frame time. A consumer on another thread
+# reads the frames in order with read_frames(). If the consumer falls too far
+# behind, the oldest frames are lost and counted in num_dropped_frames.
+class LeapCapture(Leap.Listener):
+    def __init__(self, capacity = 256):
+        Leap.Listener.__init__(self)
+        # RingBuffer only publishes a frame once its data is written, and
+        # times is written last, so its count tells how many frames are complete
+        self.hands = RingBuffer(capacity, dtype=np.float32, shape=(2, kHandRows, 3))
+        self.valid = RingBuffer(capacity, dtype=bool, shape=(2, kHandRows))
+        self.times = RingBuffer(capacity, dtype=np.float64)
+
+        self.read_count = 0
+        self.num_dropped_frames = 0
+
+        self.hands_record = np.zeros((2, kHandRows, 3), dtype=np.float32)
+        self.valid_record = np.zeros((2, kHandRows), dtype=bool)
+
+    def on_frame(self, controller):
+        frame = controller.frame()
+        leap_hands_array(frame, self.hands_record, self.valid_record)
+        self.hands.append(self.hands_record)
+        self.valid.append(self.valid_record)
+        self.times.append(frame.timestamp * 1e-6) # microseconds to seconds
+
+    # returns (times, hands, valid) arrays of all frames captured since the
+    # last call, oldest first. hands is (n, 2, kHandRows, 3) and valid is
+    # (n, 2, kHandRows), as described in pack_hands. The arrays are only
+    # valid until the next call.
+    #
+    # They are views into the ring buffers, which the Leap thread keeps
+    # writing to, so the oldest returned frames get overwritten once another
+    # capacity - n frames arrive. Views are only returned for up to half the
+    # capacity, which leaves the reader at least capacity / 2 frames (about a
+    # second at the Leap's frame rate, with the default capacity) to process
+    # them. A reader that fell further behind gets copies.
+    def read_frames(self):
+        # one slot is left free for the frame that may be being written
+        count = self.times.count
+        max_frames = self.times.capacity - 1
+        if count - self.read_count > max_frames:
+            self.num_dropped_frames += count - self.read_count - max_frames
+            self.read_count = count - max_frames
+
+        start = self.read_count
+        num = count - start
+        self.read_count = count
+        frames = (self.times.view(start, num), self.hands.view(start, num), self.valid.view(start, num))
+        if num > self.times.capacity // 2:
+            frames = tuple(np.array(f) for f in frames)
+        return frames
@@ -18,6 +18,13 @@ from kivy.graphics.instructions import InstructionGroup
 
 from kinect import Kinect, SkeletonModel
 from pykinect.nui import JointId
+from sensor_recording import SensorRecorder, SensorReplay
+from gesture_rules import GestureRule, GestureRuleEngine, pos, vel, beat, ongoing_beat, var
+
+# set kRecordPath to record the Kinect and microphone input of a session to
+# a file, or kReplayPath to run from such a recording instead of the sensors
+kRecordPath = None
+kReplayPath = None
 
 MIN_TIME_FOR_INSTRUMENT_CHANGE = 15
 SHORTER_MIN_TIME_FOR_INSTRUMENT_CHANGE = 10
@@ -29,11 +36,25 @@ class MainWidget1(BaseWidget) :
         self.phase = 0 # 0=tempo tracking, 1=pitch tracking, 2=performance
 
         self.pitchTracker = PitchTracker()
-        self.audio = Audio(2, None, self.pitchTracker.audio_input_func)
+        self.recorder = None
+        self.replay = None
+        input_func = self.pitchTracker.audio_input_func
+        if kReplayPath != None:
+            self.replay = SensorReplay(kReplayPath)
+            self.replay.set_input_func(input_func)
+            input_func = None
+        elif kRecordPath != None:
+            self.recorder = SensorRecorder()
+            input_func = self.recorder.wrap_input_func(input_func)
+        self.audio = Audio(2, None, input_func, use_callback = True)
+        if self.recorder != None:
+            self.recorder.audio_sample_rate = Audio.sample_rate
         self.tempo_map  = SimpleTempoMap(100)
 
         self.tempoProcessor = TempoProcessor(self.change_tempo, self.tempo_map)
         self.playbackSystem = PlaybackSystem(self.audio, self.tempo_map, self.tempoProcessor, self.pitchTracker)
+        self.tempoProcessor.set_clock(self.playbackSystem.sched) # beats follow the audio output clock
+        self.pitchTracker.set_clock(self.playbackSystem.sched) # pitches are timed on the same clock
         # self.gestureRecognizer = GestureRecognizer(self.quantize_time_to_beat, self.play_sound, self.tempoProcessor, self.tempo_map)
 
         # user interface objects
@@ -67,13 +88,18 @@ class MainWidget1(BaseWidget) :
 
         self.objects = [self.phase_indicator, metro_anchor, self.metro_line, self.measure_1_indicator, self.measure_2_indicator, self.measure_3_indicator, self.measure_4_indicator]
 
-        self.kinect = Kinect(1)
+        if self.replay != None:
+            self.kinect = self.replay
+        else:
+            self.kinect = Kinect(1)
         self.kinect.add_listener(self.on_kinect_update)
+        if self.recorder != None:
+            self.recorder.attach_kinect(self.kinect)
         self.skeleton = SkeletonModel()
 
-        self.time_since_downbeat = 0
         self.last_instruments = [None]
         self.time_since_last_instrument = 0
+        self.gesture_rules = GestureRuleEngine(self.make_gesture_rules(), self.phase)
 
         self.kinect.start()
 
@@ -87,99 +113,100 @@ class MainWidget1(BaseWidget) :
         self.objects.append(self.logo)
         self.intro_timer = 0
 
+    # gesture rules for each phase, evaluated on every Kinect frame
+    def make_gesture_rules(self):
+        RH, LH = JointId.HandRight, JointId.HandLeft
+        hip, left_shoulder, right_shoulder = JointId.HipCenter, JointId.ShoulderLeft, JointId.ShoulderRight
+
+        next_phase = beat(LH, "right") & (vel(LH).x > 0.1)
+
+        # instruments played recently are easier to keep playing than to switch to
+        piano_ready = (var("piano_recent") > 0.5) | (var("frames_since_instrument") > 5)
+        guitar_ready = (var("guitar_recent") > 0.5) | (var("frames_since_instrument") > SHORTER_MIN_TIME_FOR_INSTRUMENT_CHANGE)
+
+        both_hands_down = piano_ready & (beat(RH, "down") | beat(LH, "down")) & ongoing_beat(RH) & ongoing_beat(LH) & \
+                          (abs(pos(RH).y - pos(LH).y) < 0.1) & ((pos(RH).y + pos(LH).y) / 2 - pos(hip).y < 0.15)
+        # fretting with the raised left hand, strumming with the right at the hips
+        guitar_right = guitar_ready & (pos(LH).x - pos(left_shoulder).x < -0.02) & (pos(LH).y - pos(left_shoulder).y > -0.05) & \
+                       (pos(LH).y - pos(RH).y > 0.1) & (abs(pos(RH).x - pos(hip).x) < 0.2) & (abs(pos(RH).y - pos(hip).y) < 0.4)
+        guitar_left = guitar_ready & (pos(RH).x - pos(right_shoulder).x > 0.02) & (pos(RH).y - pos(right_shoulder).y > -0.05) & \
+                      (pos(RH).y - pos(LH).y > 0.1) & (abs(pos(LH).x - pos(hip).x) < 0.2) & (abs(pos(LH).y - pos(hip).y) < 0.4)
+
+        return {
+            0: [
+                GestureRule("conduct downbeat", beat(RH, "down"), self.tempoProcessor.register_downbeat, 0, exclusive = True, cooldown = 7),
+                GestureRule("next phase", next_phase, lambda: self.change_phase(1), 1),
+            ],
+            1: [
+                GestureRule("next phase", next_phase, lambda: self.change_phase(2), 0),
+            ],
+            2: [
+                GestureRule("piano", both_hands_down, self.play_piano_chord, 0, exclusive = True),
+                GestureRule("guitar right strum", guitar_right & (beat(RH, "down") | beat(RH, "up")), lambda: self.play_guitar(RH), 1, exclusive = True),
+                GestureRule("guitar right pose", guitar_right, None, 2, exclusive = True),
+                GestureRule("guitar left strum", guitar_left & (beat(LH, "down") | beat(LH, "up")), lambda: self.play_guitar(LH), 3, exclusive = True),
+                GestureRule("guitar left pose", guitar_left, None, 4, exclusive = True),
+                GestureRule("right downbeat", beat(RH, "down") & (abs(pos(RH).x - pos(hip).x) < 0.4), lambda: self.play_downbeat(RH, 35), 5),
+                GestureRule("left downbeat", beat(LH, "down") & (abs(pos(LH).x - pos(hip).x) < 0.4), lambda: self.play_downbeat(LH, 30), 6),
+                GestureRule("right snare", beat(RH, "front") & (abs(pos(RH).x - pos(hip).x) < 0.4) & (pos(RH).y - pos(hip).y > 0.2),
+                            lambda: self.play_drum(RH, 40), 7),
+                GestureRule("left snare", beat(LH, "front") & (abs(pos(LH).x - pos(hip).x) < 0.4) & (pos(LH).y - pos(hip).y > 0.2),
+                            lambda: self.play_drum(LH, 38), 8),
+                GestureRule("right cymbal", (beat(RH, "right") | beat(RH, "down") | beat(RH, "front")) & (pos(RH).x - pos(hip).x > 0.4),
+                            lambda: self.play_drum(RH, 49), 9),
+                GestureRule("left hi-hat", (beat(LH, "left") | beat(LH, "down") | beat(LH, "front")) & (pos(LH).x - pos(hip).x < -0.4),
+                            lambda: self.play_drum(LH, 46), 10),
+            ],
+        }
+
     def on_kinect_update(self, skeleton):
         self.skeleton.update(skeleton)
         if skeleton is None:
             return
-        
-        if self.phase == 0:
-            if self.skeleton[JointId.HandRight].downbeat() and self.time_since_downbeat > 6:
-                self.tempoProcessor.register_downbeat()
-                self.time_since_downbeat = 0
-            else:
-                self.time_since_downbeat += 1
-                if self.skeleton[JointId.HandLeft].rightbeat() and self.skeleton[JointId.HandLeft].vel[0] > 0.1:
-                    self.change_phase(1)
-        elif self.phase == 1:
-            self.time_since_downbeat = 0
-            if self.skeleton[JointId.HandLeft].rightbeat() and self.skeleton[JointId.HandLeft].vel[0] > 0.1:
-                self.change_phase(2)
-        elif self.phase == 2:
-            self.time_since_downbeat = 0
+
+        variables = {}
+        if self.phase == 2:
             self.time_since_last_instrument += 1
             if len(self.last_instruments) > 4:
                 self.last_instruments = self.last_instruments[1:]
-            if ('piano' in self.last_instruments or self.time_since_last_instrument > 5) and \
-                    (self.skeleton[JointId.HandRight].downbeat() or self.skeleton[JointId.HandLeft].downbeat()) and \
-                    self.skeleton[JointId.HandRight].ongoing_beat_vel is not None and self.skeleton[JointId.HandLeft].ongoing_beat_vel is not None and \
-                    abs(skeleton[JointId.HandRight].y - skeleton[JointId.HandLeft].y) < 0.1 and \
-                    (skeleton[JointId.HandRight].y+skeleton[JointId.HandLeft].y)/2 - skeleton[JointId.HipCenter].y < 0.15:
-                self.playbackSystem.play_chord_performance('piano', (self.skeleton[JointId.HandRight].ongoing_beat_vel + self.skeleton[JointId.HandLeft].ongoing_beat_vel) / 2)
-                self.last_instruments.append('piano')
-                self.time_since_last_instrument = 0
-            elif ('guitar' in self.last_instruments or self.time_since_last_instrument > SHORTER_MIN_TIME_FOR_INSTRUMENT_CHANGE) and \
-                    skeleton[JointId.HandLeft].x - skeleton[JointId.ShoulderLeft].x < -0.02 and skeleton[JointId.HandLeft].y - skeleton[JointId.ShoulderLeft].y > -0.05 and \
-                    skeleton[JointId.HandLeft].y - skeleton[JointId.HandRight].y > 0.1 and \
-                    abs(skeleton[JointId.HandRight].x - skeleton[JointId.HipCenter].x) < 0.2 and abs(skeleton[JointId.HandRight].y - skeleton[JointId.HipCenter].y) < 0.4:
-                if self.skeleton[JointId.HandRight].downbeat() or self.skeleton[JointId.HandRight].upbeat():
-                    self.playbackSystem.play_chord_performance('guitar', self.skeleton[JointId.HandRight].beat.vel)
-                    self.last_instruments.append('guitar')
-                    self.time_since_last_instrument = 0
-            elif ('guitar' in self.last_instruments or self.time_since_last_instrument > SHORTER_MIN_TIME_FOR_INSTRUMENT_CHANGE) and \
-                    skeleton[JointId.HandRight].x - skeleton[JointId.ShoulderRight].x > 0.02 and skeleton[JointId.HandRight].y - skeleton[JointId.ShoulderRight].y > -0.05 and \
-                    skeleton[JointId.HandRight].y - skeleton[JointId.HandLeft].y > 0.1 and \
-                    abs(skeleton[JointId.HandLeft].x - skeleton[JointId.HipCenter].x) < 0.2 and abs(skeleton[JointId.HandLeft].y - skeleton[JointId.HipCenter].y) < 0.4:
-                if self.skeleton[JointId.HandLeft].downbeat() or self.skeleton[JointId.HandLeft].upbeat():
-                    self.playbackSystem.play_chord_performance('guitar', self.skeleton[JointId.HandLeft].beat.vel)
-                    self.last_instruments.append('guitar')
-                    self.time_since_last_instrument = 0
-            else:
-                if self.skeleton[JointId.HandRight].downbeat() and abs(skeleton[JointId.HandRight].x - skeleton[JointId.HipCenter].x) < 0.4:
-                    if (self.last_instruments[-1] == 'drums' or self.time_since_last_instrument > MIN_TIME_FOR_INSTRUMENT_CHANGE):
-                        self.playbackSystem.play_sound('bass drums', 35, self.skeleton[JointId.HandRight].beat.vel)
-                        self.last_instruments.append('drums')
-                        self.time_since_last_instrument = 0
-                    elif self.last_instruments[-1] == 'piano':
-                        self.playbackSystem.play_chord_performance('piano', self.skeleton[JointId.HandRight].beat.vel)
-                        self.last_instruments.append('piano')
-                        self.time_since_last_instrument = 0
-                    elif self.last_instruments[-1] == 'guitar':
-                        self.playbackSystem.play_chord_performance('guitar', self.skeleton[JointId.HandRight].beat.vel)
-                        self.last_instruments.append('guitar')
-                        self.time_since_last_instrument = 0
-                if self.skeleton[JointId.HandLeft].downbeat() and abs(skeleton[JointId.HandLeft].x - skeleton[JointId.HipCenter].x) < 0.4:
-                    if (self.last_instruments[-1] == 'drums' or self.time_since_last_instrument > MIN_TIME_FOR_INSTRUMENT_CHANGE):
-                        self.playbackSystem.play_sound('bass drums', 30, self.skeleton[JointId.HandLeft].beat.vel)
-                        self.last_instruments.append('drums')
-                        self.time_since_last_instrument = 0
-                    elif self.last_instruments[-1] == 'piano':
-                        self.playbackSystem.play_chord_performance('piano', self.skeleton[JointId.HandLeft].beat.vel)
-                        self.last_instruments.append('piano')
-                        self.time_since_last_instrument = 0
-                    elif self.last_instruments[-1] == 'guitar':
-                        self.playbackSystem.play_chord_performance('guitar', self.skeleton[JointId.HandLeft].beat.vel)
-                        self.last_instruments.append('guitar')
-                        self.time_since_last_instrument = 0
-                if self.skeleton[JointId.HandRight].frontbeat() and abs(skeleton[JointId.HandRight].x - skeleton[JointId.HipCenter].x) < 0.4 and \
-                        skeleton[JointId.HandRight].y - skeleton[JointId.HipCenter].y > 0.2:
-                    self.playbackSystem.play_sound('drums', 40, self.skeleton[JointId.HandRight].beat.vel)
-                    self.last_instruments.append('drums')
-                    self.time_since_last_instrument = 0
-                if self.skeleton[JointId.HandLeft].frontbeat() and abs(skeleton[JointId.HandLeft].x - skeleton[JointId.HipCenter].x) < 0.4 and \
-                        skeleton[JointId.HandLeft].y - skeleton[JointId.HipCenter].y > 0.2:
-                    self.playbackSystem.play_sound('drums', 38, self.skeleton[JointId.HandLeft].beat.vel)
-                    self.last_instruments.append('drums')
-                    self.time_since_last_instrument = 0
-                if (self.skeleton[JointId.HandRight].rightbeat() or self.skeleton[JointId.HandRight].downbeat() or self.skeleton[JointId.HandRight].frontbeat()) and skeleton[JointId.HandRight].x - skeleton[JointId.HipCenter].x > 0.4:
-                    self.playbackSystem.play_sound('drums', 49, self.skeleton[JointId.HandRight].beat.vel)
-                    self.last_instruments.append('drums')
-                    self.time_since_last_instrument = 0
-                if (self.skeleton[JointId.HandLeft].leftbeat() or self.skeleton[JointId.HandLeft].downbeat() or self.skeleton[JointId.HandLeft].frontbeat()) and skeleton[JointId.HandLeft].x - skeleton[JointId.HipCenter].x < -0.4:
-                    self.playbackSystem.play_sound('drums', 46, self.skeleton[JointId.HandLeft].beat.vel)
-                    self.last_instruments.append('drums')
-                    self.time_since_last_instrument = 0
+            variables["piano_recent"] = 'piano' in self.last_instruments
+            variables["guitar_recent"] = 'guitar' in self.last_instruments
+            variables["frames_since_instrument"] = self.time_since_last_instrument
 
+        self.gesture_rules.update(self.skeleton, variables)
 
+    def played_instrument(self, instrument):
+        self.last_instruments.append(instrument)
+        self.time_since_last_instrument = 0
+
+    def play_piano_chord(self):
+        self.playbackSystem.play_chord_performance('piano', (self.skeleton[JointId.HandRight].ongoing_beat_vel + self.skeleton[JointId.HandLeft].ongoing_beat_vel) / 2)
+        self.played_instrument('piano')
+
+    def play_guitar(self, hand):
+        self.playbackSystem.play_chord_performance('guitar', self.skeleton[hand].beat.vel)
+        self.played_instrument('guitar')
+
+    def play_drum(self, hand, pitch):
+        self.playbackSystem.play_sound('drums', pitch, self.skeleton[hand].beat.vel)
+        self.played_instrument('drums')
+
+    # a downbeat plays a bass drum, unless a chord instrument was played last
+    # and it's too soon to switch back to drums
+    def play_downbeat(self, hand, pitch):
+        if (self.last_instruments[-1] == 'drums' or self.time_since_last_instrument > MIN_TIME_FOR_INSTRUMENT_CHANGE):
+            self.playbackSystem.play_sound('bass drums', pitch, self.skeleton[hand].beat.vel)
+            self.played_instrument('drums')
+        elif self.last_instruments[-1] == 'piano':
+            self.playbackSystem.play_chord_performance('piano', self.skeleton[hand].beat.vel)
+            self.played_instrument('piano')
+        elif self.last_instruments[-1] == 'guitar':
+            self.playbackSystem.play_chord_performance('guitar', self.skeleton[hand].beat.vel)
+            self.played_instrument('guitar')
+
+    def on_close(self):
+        if self.recorder != None:
+            self.recorder.save(kRecordPath)
 
     def on_key_down(self, keycode, modifiers):
         print("Key pressed: "+str(keycode))
@@ -196,6 +223,7 @@ class MainWidget1(BaseWidget) :
         if self.phase != new_phase and self.intro_timer > 8.0:
             self.phase = new_phase
             self.phase_ind_anim_x = 0
+            self.gesture_rules.set_phase(self.phase)
 
             if self.phase == 1:
                 self.pitchTracker.tracking = True
@@ -214,19 +242,24 @@ class MainWidget1(BaseWidget) :
         dt = kivyClock.frametime
         self.intro_timer += dt
 
+        # holds the intro logo until the SoundFont has finished loading
+        if not self.playbackSystem.is_ready():
+            self.intro_timer = min(self.intro_timer, 4.5)
+
         if self.intro_timer > 4.5:
             self.logo.color.a = max(0, self.logo.color.a-(dt*0.7))
             self.logo_bg.color.a = max(0, self.logo.color.a-(dt*0.7))
 
         self.phase_ind_anim_x = min(self.phase_ind_anim_x+dt, 100)
 
+        self.kinect.on_update()
         self.pitchTracker.on_update(dt)
         self.playbackSystem.on_update(dt)
         # self.gestureRecognizer.on_update(dt)
         self.tempoProcessor.on_update(dt)
 
         # metronome interface updates
-        self.metro_anim_x += dt * (self.tempo_map.bpm * 1.0 / 60.0) * np.pi
+        self.metro_anim_x = self.tempoProcessor.beat * np.pi
         h = Window.height*0.4
         x = (np.sin(self.metro_anim_x + (np.pi*0.5))*Window.width*0.15)
         theta = np.arctan(x/h)
@@ -235,13 +268,18 @@ class MainWidget1(BaseWidget) :
 
         # beat indicator updates
         current_measure = self.tempoProcessor.current_beat(4)
+        current_chord = None
+        if self.phase == 1:
+            current_chord = self.pitchTracker.get_current_chord()
         for i in range(len(self.measure_indicators)):
             indicator = self.measure_indicators[i]
 
             if current_measure == i:
-                indicator.color.r = 0.5
+                # shifts towards green as the live chord estimate gets more confident
+                chord_confidence = current_chord[2] if current_chord != None else 0.0
+                indicator.color.r = 0.5 - (chord_confidence*0.35)
                 indicator.color.g = 0.5
-                indicator.color.b = 1.0
+                indicator.color.b = 1.0 - (chord_confidence*0.85)
             elif self.playbackSystem.chord_progression[i] != None:
                 indicator.color.r = 0.15
                 indicator.color.g = 0.5
@@ -1,8 +1,11 @@
 from math import *
 import numpy as np
 import aubio
-from collections import Counter
+from collections import deque
 import sys
+from ring_buffer import RingBuffer
+from chord_recognizer import ChordRecognizer
+from common.audio import Audio
 
 A4 = 440
 C0 = A4*pow(2, -4.75)
@@ -11,29 +14,84 @@ def freq_to_pitch(freq):
     h = round(12*log(max(freq, 0.00001)/(max(C0, 0.00001)), 2))
     return h
 
+# returns the n most common values in pitches as (pitch, count) tuples, most
+# common first. Ties are ordered by first appearance, like Counter.most_common
+def most_common_pitches(pitches, n):
+    values, first_idx, counts = np.unique(pitches, return_index=True, return_counts=True)
+    order = np.lexsort((first_idx, -counts))[:n]
+    return [(float(values[i]), int(counts[i])) for i in order]
+
+# checks whether some run of 5 consecutive pitches contains base_pitch at
+# least 3 times and spans no more than 2 semitones
+def is_sufficiently_continuous(pitches, base_pitch, window = 5):
+    if len(pitches) < window:
+        return False
+
+    # number of base pitches in each window, from a running count
+    base_running_count = np.concatenate(([0], np.cumsum(pitches == base_pitch)))
+    base_counts = base_running_count[window:] - base_running_count[:-window]
+
+    # pitch range of each window, from a strided view of all windows
+    stride = pitches.strides[0]
+    windows = np.lib.stride_tricks.as_strided(pitches, shape=(len(pitches) - window + 1, window), strides=(stride, stride))
+    ranges = windows.max(axis=1) - windows.min(axis=1)
+
+    return bool(np.any((base_counts >= 3) & (ranges <= 2)))
+
 class PitchTracker(object):
-    def __init__(self):
+    # window_size is the number of samples aubio analyzes per estimate and
+    # hop_size is the number of new samples between estimates
+    def __init__(self, window_size = 1024, hop_size = 512):
+        # transport clock (anything with get_time(), such as the AudioScheduler
+        # that plays our notes). Until one is set, time is counted in input samples.
+        self.clock = None
+        self.clock_offset = 0.0 # clock time of input sample 0
         self.t = 0
 
         self.max_time_range = 0.075 # seconds
-        self.samples = [] # list of lists of frames with timestamps
-        self.all_frames = [] # concatenated list of tracked frames over time range
+        self.window_size = window_size
+        self.hop_size = hop_size
+
+        # timestamped (t, pitch, confidence, volume) frames produced from audio
+        # input, waiting to be consumed in on_update
+        self.pitch_frames = deque()
 
         self.current_pitches = []
+        self.chord_recognizer = ChordRecognizer()
+
+        self._setup(Audio.sample_rate)
+
+        self.tracking = False
+
+    # (re)creates the input buffer and pitch detector for a sample rate
+    def _setup(self, sample_rate):
+        self.sample_rate = sample_rate
 
-        self.pDetection = aubio.pitch("default", 1024, 1024, 44100)
+        # most recent mono input samples, covering at least max_time_range
+        # plus one hop that hasn't been analyzed yet
+        self.volume_window = max(int(self.max_time_range * sample_rate), self.window_size)
+        self.samples = RingBuffer(self.volume_window + self.hop_size, dtype=aubio.float_type)
+        self.volume_scratch = np.zeros(self.volume_window, dtype=aubio.float_type)
+        self.analyzed_count = 0 # sample index at which the next hop starts
+
+        self.pDetection = aubio.pitch("default", self.window_size, self.hop_size, sample_rate)
         self.pDetection.set_unit("Hz")
         self.pDetection.set_silence(-40)
 
-        self.tracking = False
+    # pitch frames are timestamped on the clock, so that they line up with the
+    # beats and notes of the TempoProcessor and PlaybackSystem using it
+    def set_clock(self, clock):
+        self.clock = clock
+        self.t = clock.get_time()
 
     def get_relevant_pitches_and_clear(self):
         relevant_pitches = []
 
         if len(self.current_pitches) > 0:
-            
+            pitches = np.array(self.current_pitches)
+
             # gets most common pitches
-            common_pitches_and_frequencies = Counter(self.current_pitches).most_common(3)
+            common_pitches_and_frequencies = most_common_pitches(pitches, 3)
             sorted_common_pitches_and_frequencies = sorted(common_pitches_and_frequencies)
 
             print("Most common pitches: "+str(common_pitches_and_frequencies))
@@ -49,25 +107,7 @@ class PitchTracker(object):
                 if base_note[1] > 8:
 
                     # checks that base notes are relatively continuous in recorded pitches
-                    base_sufficiently_continuous = False
-                    for i in range(2, len(self.current_pitches)-2):
-                        subset = self.current_pitches[i-2:i+3]
-                        base_count = 0
-
-                        min_pitch = 99999
-                        max_pitch = 0
-                        for pitch in subset:
-                            min_pitch = min(min_pitch, pitch)
-                            max_pitch = max(max_pitch, pitch)
-                            if pitch == base_note[0]:
-                                base_count += 1
-                        max_range = abs(min_pitch-max_pitch)
-
-                        if base_count >= 3 and max_range <= 2:
-                            base_sufficiently_continuous = True
-                            break
-
-                    if base_sufficiently_continuous == True:
+                    if is_sufficiently_continuous(pitches, base_note[0]):
                         # extracts supporting note
                         best_match = None
                         for pitch_and_freq in common_pitches_and_frequencies:
@@ -79,34 +119,67 @@ class PitchTracker(object):
                         if best_match != None: relevant_pitches.append(best_match[0])
 
         self.current_pitches = []
+        self.chord_recognizer.clear()
         return relevant_pitches
 
+    # returns (root, chord_type, confidence) of the chord heard since the last
+    # clear, or None
+    def get_current_chord(self):
+        return self.chord_recognizer.get_chord()
+
     def audio_input_func(self, frames, num_channels):
         if self.tracking == True:
-            deinterlaced_frames = frames[::num_channels]
-            self.samples.append( (deinterlaced_frames, self.t) )
-
-            self.current_pitch = None
-            self.all_frames = []
-            if len(self.samples) > 3:
-                while np.absolute(self.samples[0][1]-self.samples[-1][1]) > self.max_time_range:
-                    self.samples = self.samples[1:]
-
-                for sample in self.samples:
-                    self.all_frames.extend(sample[0])
-
-                avg_volume = np.mean(np.absolute(self.all_frames))
-                if avg_volume > 0.01: #0.045: # tracks current pitch if volume is loud enough
-
-                    aubio_samples = np.array(self.all_frames[-1024:], dtype=aubio.float_type)
-                    if len(aubio_samples) >= 1024:
-                        freq = self.pDetection(aubio_samples)[0]
-                        pitch = freq_to_pitch(freq)
-                        if pitch > 12:
-                            self.current_pitches.append(pitch)
-
-                            # print("PITCH:" + str(pitch))
+            # Audio driver may have changed the sample rate after we were created
+            if Audio.sample_rate != self.sample_rate:
+                self._setup(Audio.sample_rate)
+
+            # feed the buffer one hop at a time, so that every sample gets
+            # analyzed exactly once no matter how large the input block is
+            mono_frames = frames[::num_channels]
+
+            # maps input sample indices onto the clock, with the last sample
+            # of this block arriving at the clock's current time
+            if self.clock != None:
+                end_count = self.samples.count + len(mono_frames)
+                self.clock_offset = self.clock.get_time() - end_count / float(self.sample_rate)
+
+            for start in range(0, len(mono_frames), self.hop_size):
+                self.samples.write(mono_frames[start:start + self.hop_size])
+                while self.samples.count - self.analyzed_count >= self.hop_size:
+                    self._analyze_hop()
+
+    # runs pitch detection on the next unanalyzed hop of samples
+    def _analyze_hop(self):
+        hop = self.samples.view(self.analyzed_count, self.hop_size)
+        self.analyzed_count += self.hop_size
+
+        # the detector keeps its own analysis window, so it must see every hop
+        freq = self.pDetection(hop)[0]
+        confidence = self.pDetection.get_confidence()
+
+        if self.analyzed_count < self.volume_window:
+            return
+
+        window = self.samples.view(self.analyzed_count - self.volume_window, self.volume_window)
+        np.absolute(window, out=self.volume_scratch)
+        avg_volume = np.mean(self.volume_scratch)
+        if avg_volume > 0.01: #0.045: # tracks current pitch if volume is loud enough
+            pitch = freq_to_pitch(freq)
+            if pitch > 12:
+                t = self.clock_offset + self.analyzed_count / float(self.sample_rate)
+                self.pitch_frames.append( (t, pitch, confidence, avg_volume) )
+
+                # print("PITCH:" + str(pitch))
 
     def on_update(self, dt):
-        self.t += dt
+        # the same clock that timestamps pitch_frames
+        if self.clock != None:
+            self.t = self.clock.get_time()
+        else:
+            self.t = self.analyzed_count / float(self.sample_rate)
+
+        while self.pitch_frames:
+            (t, pitch, confidence, volume) = self.pitch_frames.popleft()
+            self.current_pitches.append(pitch)
+            self.chord_recognizer.add_pitch(t, pitch, confidence * volume * volume)
 
@@ -9,135 +9,176 @@ from common.clock import *
 from common.metro import *
 from common.mixer import *
 
+from chord_recognizer import CHORD_TYPES
+
+# semitone intervals above the base for each chord type
+CHORD_INTERVALS = dict(CHORD_TYPES)
 
 class Chord(object):
-    def __init__(self, pitches):
+    # chord_type is one of CHORD_INTERVALS' keys. If not given, it is guessed
+    # as major or minor from the first two pitches
+    def __init__(self, pitches, chord_type = None):
         pitches.sort()
 
         self.base = pitches[0]
-        self.type = "major"
-        if pitches[1] == pitches[0]+3:
-            self.type = "minor"
+        self.type = chord_type
+        if self.type == None:
+            self.type = "major"
+            if pitches[1] == pitches[0]+3:
+                self.type = "minor"
             
     def get_pitches(self, for_feedback, base_estimate = None, top_note_estimate = None):
-        pitches = [self.base]
-
-        # estimates current chord's base note when given estimate
-        not_inverted = True
-        if base_estimate != None:
-            base_estimate_octave = base_estimate // 12
-            offset = base_estimate-(base_estimate_octave*12)
-            base_octave = self.base // 12
-            base_offset = (self.base-(base_octave*12))
-
-            interval_base = abs(offset - base_offset)
-            interval_third = abs(offset - (base_offset + 3))
-            if self.type == "major": interval_third = abs(offset - (base_offset + 4))
-            interval_fifth = abs(offset - (base_offset + 7))
-            interval_octave = abs(offset - (base_offset + 12))
-            closest_interval = min(min(min(interval_base, interval_third), interval_fifth), interval_octave)
-
-            new_base = (base_estimate_octave*12)+base_offset
-            if closest_interval == interval_third and self.type == "major":
-                new_base += 4
-                not_inverted = False
-            elif closest_interval == interval_third and self.type == "minor":
-                new_base += 3
-                not_inverted = False
-            elif closest_interval == interval_fifth:
-                new_base += 7
-                not_inverted = False
-            elif closest_interval == interval_octave:
-                new_base += 12
-
-            pitches = [new_base]
+        key = (self.base, self.type, for_feedback, base_estimate, top_note_estimate)
+        if key not in g_voicing_cache:
+            g_voicing_cache[key] = tuple(build_chord_pitches(*key))
+        return list(g_voicing_cache[key])
+
+# voicings are only a function of these few discrete inputs, so they are
+# computed once and shared across all Chord instances.
+# maps (base, chord_type, for_feedback, base_estimate, top_note_estimate) -> pitches
+g_voicing_cache = {}
+
+def build_chord_pitches(base, chord_type, for_feedback, base_estimate = None, top_note_estimate = None):
+    pitches = [base]
+    third = CHORD_INTERVALS[chord_type][1]
+    fifth = CHORD_INTERVALS[chord_type][2]
+
+    # estimates current chord's base note when given estimate
+    not_inverted = True
+    if base_estimate != None:
+        base_estimate_octave = base_estimate // 12
+        offset = base_estimate-(base_estimate_octave*12)
+        base_octave = base // 12
+        base_offset = (base-(base_octave*12))
+
+        interval_base = abs(offset - base_offset)
+        interval_third = abs(offset - (base_offset + third))
+        interval_fifth = abs(offset - (base_offset + fifth))
+        interval_octave = abs(offset - (base_offset + 12))
+        closest_interval = min(min(min(interval_base, interval_third), interval_fifth), interval_octave)
+
+        new_base = (base_estimate_octave*12)+base_offset
+        if closest_interval == interval_third:
+            new_base += third
+            not_inverted = False
+        elif closest_interval == interval_fifth:
+            new_base += fifth
+            not_inverted = False
+        elif closest_interval == interval_octave:
+            new_base += 12
+
+        pitches = [new_base]
+    else:
+        if for_feedback == True: # plays chords in higher octaves while tracking pitch
+            while pitches[0] < 62:
+                pitches[0] += 12
         else:
-            if for_feedback == True: # plays chords in higher octaves while tracking pitch
-                while pitches[0] < 62:
-                    pitches[0] += 12
+            while pitches[0] > 60:
+                pitches[0] += -12
+
+    # builds chord from base to reach top note estimate
+    if not_inverted == False: top_note_estimate = pitches[0] + 16
+    if top_note_estimate != None and top_note_estimate > pitches[0] + 12:
+        for i in range(pitches[0]+1, top_note_estimate+1):
+            octave = i // 12
+            offset = i-(octave*12)
+            base_octave = pitches[0] // 12
+            base_offset = pitches[0]-(base_octave*12)
+
+            interval = offset - base_offset
+            if interval < 0: interval += 12
+            if interval >= 12: interval += -12
+
+            if interval == third or interval == fifth:
+                pitches.append(i)
+
+        # cuts out third on bottom chord if enough pitches are generated
+        if len(pitches) >= 5 and not_inverted == True:
+            pitches = [pitches[0]]+pitches[2:]
+
+    elif not_inverted == True: # standard pitches construction
+        pitches.append(pitches[0]+third)
+        pitches.append(pitches[0]+fifth)
+
+    return pitches
+
+kSoundFontPath = 'sfx/FluidR3_GM.sf2'
+
+# metronome that accents the first beat of each measure (and the first
+# measure of each 4-measure phrase), and plays softer during performance
+class AccentedMetronome(Metronome):
+    def __init__(self, sched, synth, channel, playback_system):
+        super(AccentedMetronome, self).__init__(sched, synth, channel, (128, 0), 45)
+        self.playback_system = playback_system
+
+    def get_velocity(self, tick):
+        beat = int(round(float(tick) / self.beat_len))
+        if beat % 4 == 0:
+            if (beat // 4) % 4 == 0:
+                vel = 90
             else:
-                while pitches[0] > 60:
-                    pitches[0] += -12
-
-        # builds chord from base to reach top note estimate
-        if not_inverted == False: top_note_estimate = pitches[0] + 16
-        if top_note_estimate != None and top_note_estimate > pitches[0] + 12:
-            for i in range(pitches[0]+1, top_note_estimate+1):
-                octave = i // 12
-                offset = i-(octave*12)
-                base_octave = pitches[0] // 12
-                base_offset = pitches[0]-(base_octave*12)
-
-                interval = offset - base_offset
-                if interval < 0: interval += 12
-                if interval >= 12: interval += -12
-
-                if self.type == "major" and interval == 4:
-                    pitches.append(i)
-                elif self.type == "minor" and interval == 3:
-                    pitches.append(i)
-                elif interval == 7:
-                    pitches.append(i)
-
-            # cuts out third on bottom chord if enough pitches are generated
-            if len(pitches) >= 5 and not_inverted == True:
-                pitches = pitches[0]+pitches[2:]
-
-        elif not_inverted == True: # standard pitches construction
-            if self.type == "major":
-                pitches.append(pitches[0]+4)
-                pitches.append(pitches[0]+7)
-            elif self.type == "minor":
-                pitches.append(pitches[0]+3)
-                pitches.append(pitches[0]+7)
-
-        return pitches
+                vel = 75
+        else:
+            vel = 50
+        if self.playback_system.performing == True and beat % 4 != 0:
+            vel = int(vel * 0.5)
+        return vel
 
 class PlaybackSystem(object):
     def __init__(self, audio, tempo_map, tempo_processor, pitch_tracker):
-        self.channel = 0
-
         self.audio = audio
         self.tempo_map = tempo_map
         self.tempo_processor = tempo_processor
         self.pitch_tracker = pitch_tracker
 
+        # metronome and performance share one synth, on separate channels.
+        # The SoundFont loads in the background, and self.synth stays None
+        # (and nothing plays) until _on_synth_ready is called.
+        self.synth_pool = get_synth_pool()
+        self.synth = None
+        self.metro_channel = self.synth_pool.allocate_channel(kSoundFontPath)
+        self.performance_channel = self.synth_pool.allocate_channel(kSoundFontPath)
+        self.previous_notes = {self.metro_channel: [], self.performance_channel: []}
+        self.metro = None
+
         self.mixer = Mixer()
-        self.metro_synth = Synth('sfx/FluidR3_GM.sf2')
-        self.previous_note_metro = None
-        self.mixer.add(self.metro_synth)
-        self.performance_synth = Synth('sfx/FluidR3_GM.sf2')
-        self.previous_note = None
-        self.mixer.add(self.performance_synth)
+        self.synth_pool.load_async(kSoundFontPath, self._on_synth_ready)
 
-        self.audio.set_generator(self.mixer)
+        # all note events go through the audio scheduler, so they happen at an
+        # exact audio frame instead of whenever the UI frame ran. Performance
+        # sounds are additionally snapped to the next grid tick.
+        self.sched = AudioScheduler(tempo_map)
+        self.sched.set_generator(self.mixer)
+        self.performance_grid = kTicksPerQuarter / 4
+        self.audio.set_generator(self.sched)
 
         self.current_measure = 0
         self.current_beat = 0
         self.t = 0
 
         self.chord_progression = [None, None, None, None]
+        self.chord_confidence_threshold = 0.85 # minimum template match to trust the chord recognizer
         self.performing = False
 
+    def _on_synth_ready(self, synth):
+        self.synth = synth
+        self.mixer.add(self.synth)
+
+        # metronome clicks are posted one beat ahead on the audio scheduler.
+        # They are scheduled by tick, so a tempo change moves pending clicks too.
+        self.metro = AccentedMetronome(self.sched, self.synth, self.metro_channel, self)
+        self.metro.start()
+
+    def is_ready(self):
+        return self.synth != None
+
     def on_update(self, dt):
-        self.t += dt
+        self.t = self.sched.get_time()
+        self.synth_pool.on_update()
         self.audio.on_update()
 
         measure = self.tempo_processor.current_beat(4)
-        beat = self.tempo_processor.current_beat()
-        if self.current_beat != beat:
-            self.current_beat = beat
-
-            if self.current_beat % 4 == 0:
-                if measure == 0:
-                    vel = 90
-                else:
-                    vel = 75
-            else:
-                vel = 50
-            if self.performing == True and beat != 0:
-                vel = int(vel * 0.5)
-            self.play_sound("tick", 45, vel)
+        self.current_beat = self.tempo_processor.current_beat()
 
         if self.current_measure != measure:
             previous_measure = self.current_measure
@@ -150,16 +191,28 @@ class PlaybackSystem(object):
                     pitches = current_chord.get_pitches(True)
                     self.play_chord("guitar", pitches, 50)
 
-            # updates chord progression if necessary
+            # updates chord progression if necessary. Prefers the chord
+            # recognizer, and falls back to the most common sung pitches
             if self.pitch_tracker.tracking == True:
+                recognized_chord = self.pitch_tracker.get_current_chord()
                 relevant_pitches = self.pitch_tracker.get_relevant_pitches_and_clear()
-                if len(relevant_pitches) > 1:
+
+                new_chord = None
+                if recognized_chord != None and recognized_chord[2] >= self.chord_confidence_threshold:
+                    new_chord = Chord([48 + recognized_chord[0]], recognized_chord[1])
+                elif len(relevant_pitches) > 1:
                     new_chord = Chord(relevant_pitches)
+
+                if new_chord != None:
                     self.chord_progression[int(previous_measure % len(self.chord_progression))] = new_chord
                     print("NEW CHORD REGISTERED FOR MEASURE: "+str(previous_measure))
+                    print("   RECOGNIZED CHORD: "+str(recognized_chord))
                     print("   RELEVANT PITCHES: "+str(relevant_pitches))
 
     def play_sound(self, instrument = "tick", pitch = 45, velocity = 75):
+        if self.synth == None:
+            return
+
         velocity = volume_for(instrument, velocity)
 
         patch = (128, 0)
@@ -171,22 +224,15 @@ class PlaybackSystem(object):
             patch = (8, 116)
 
         if instrument == "tick":
-            if self.previous_note_metro != None:
-                for previous_note in self.previous_note_metro:
-                    self.metro_synth.noteoff(self.channel, int(previous_note))
-            self.metro_synth.program(self.channel, patch[0], patch[1])
-            self.metro_synth.noteon(self.channel, int(pitch), int(velocity))
-            self.previous_note_metro = [pitch]
+            self._post_notes(self.metro_channel, patch, [pitch], velocity, False)
         else:
-            if self.previous_note != None:
-                for previous_note in self.previous_note:
-                    self.performance_synth.noteoff(self.channel, int(previous_note))
-            self.performance_synth.program(self.channel, patch[0], patch[1])
-            self.performance_synth.noteon(self.channel, int(pitch), int(velocity))
-            self.previous_note = [pitch]
+            self._post_notes(self.performance_channel, patch, [pitch], velocity, True)
 
     # this function should be reserved for the metronome
-    def play_chord(self, instrument = "piano", pitches = [], velocity = 80):
+    def play_chord(self, instrument = "piano", pitches = [], velocity = 80, quantize = False):
+        if self.synth == None:
+            return
+
         patch = (0, 2)
         if instrument == "clav":
             patch = (0, 7)
@@ -201,13 +247,25 @@ class PlaybackSystem(object):
         elif instrument == "sax":
             patch = (0, 66)
 
-        if self.previous_note != None:
-            for previous_note in self.previous_note:
-                self.performance_synth.noteoff(self.channel, int(previous_note))
-        self.performance_synth.program(self.channel, patch[0], patch[1])
+        self._post_notes(self.performance_channel, patch, pitches, velocity, quantize)
+
+    # schedules the notes to be played on the audio thread: at the next
+    # performance grid tick if quantize is True, otherwise right away.
+    def _post_notes(self, channel, patch, pitches, velocity, quantize):
+        tick = self.sched.get_tick()
+        if quantize and self.performance_grid:
+            tick = quantize_tick_up(tick, self.performance_grid)
+        self.sched.post_at_tick(self._play_notes, tick, (channel, patch, pitches, velocity))
+
+    # replaces whatever was playing on the channel with the given notes
+    def _play_notes(self, tick, notes):
+        (channel, patch, pitches, velocity) = notes
+        for previous_note in self.previous_notes[channel]:
+            self.synth.noteoff(channel, int(previous_note))
+        self.synth.program(channel, patch[0], patch[1])
         for pitch in pitches:
-            self.performance_synth.noteon(self.channel, int(pitch), int(velocity))
-        self.previous_note = pitches
+            self.synth.noteon(channel, int(pitch), int(velocity))
+        self.previous_notes[channel] = pitches
 
     # call this for all non-metronome sounds
     def play_chord_performance(self, instrument = "piano", velocity = 95):
@@ -221,7 +279,7 @@ class PlaybackSystem(object):
             current_chord = self.chord_progression[int((self.current_measure+1) % len(self.chord_progression))]
         if current_chord != None:
             pitches = current_chord.get_pitches(False)
-            self.play_chord(instrument, pitches, velocity)
+            self.play_chord(instrument, pitches, velocity, True)
 
 def volume_for(instrument, vel):
     if type(vel) is int:
@@ -0,0 +1,61 @@
+import numpy as np
+
+# Fixed-capacity circular buffer of samples, indexed by the total number of
+# samples ever written. Every sample is stored twice (at i and i+capacity), so
+# any run of up to capacity recent samples is always available as one
+# contiguous numpy view, without copying or allocating on read.
+class RingBuffer(object):
+    def __init__(self, capacity, dtype=np.float32, shape=()):
+        self.capacity = capacity
+        self.data = np.zeros((2 * capacity,) + tuple(shape), dtype=dtype)
+        self.count = 0 # total number of samples written so far
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def clear(self):
+        self.count = 0
+
+    # appends one sample
+    def append(self, sample):
+        idx = self.count % self.capacity
+        self.data[idx] = sample
+        self.data[idx + self.capacity] = sample
+        self.count += 1
+
+    # appends an array of samples. If more than capacity samples are given,
+    # only the most recent ones are kept.
+    def write(self, samples):
+        num = len(samples)
+        if num > self.capacity:
+            samples = samples[-self.capacity:]
+            self.count += num - self.capacity
+            num = self.capacity
+
+        start = self.count % self.capacity
+        first = min(num, self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[start + self.capacity:start + self.capacity + first] = samples[:first]
+
+        rest = num - first
+        if rest > 0:
+            self.data[:rest] = samples[first:]
+            self.data[self.capacity:self.capacity + rest] = samples[first:]
+
+        # count is only advanced once the data is in place, so a reader on
+        # another thread never sees samples that haven't been written yet
+        self.count += num
+
+    # returns a view of the most recent num samples (or fewer, if fewer
+    # have been written)
+    def latest(self, num):
+        num = min(num, len(self))
+        end = self.count % self.capacity + self.capacity
+        return self.data[end - num:end]
+
+    # returns a view of num samples starting at absolute sample index start.
+    # The samples must still be held by the buffer.
+    def view(self, start, num):
+        assert(start >= self.count - self.capacity and start + num <= self.count)
+        idx = start % self.capacity
+        return self.data[idx:idx + num]
@@ -0,0 +1,225 @@
+import time
+from collections import namedtuple
+import numpy as np
+from kinect import NUM_JOINTS, joint_index, skeleton_to_array
+from leaputil import kMaxFingers
+
+# Records the Kinect skeleton, Leap hand and microphone streams of a session
+# into one .npz file of timestamped arrays, and replays them through the same
+# interfaces the live sources use, so the gesture-to-sound pipeline can run
+# (and be profiled) without any hardware attached.
+#
+# Streams in the file, each with a matching array of timestamps in seconds:
+#   skeleton_times (N,), skeleton_joints (N, NUM_JOINTS, 3), skeleton_tracked (N,)
+#   leap_times (M,), leap_palms (M, 2, 3), leap_fingers (M, 2, kMaxFingers, 3),
+#       leap_num_fingers (M, 2), with hand 0 = left and hand 1 = right
+#   audio_times (K,), audio_offsets (K+1,) into audio_samples, audio_channels (K,),
+#       audio_sample_rate
+
+kSkeletonStream, kLeapStream, kAudioStream = range(3)
+
+# joint position with the same x, y, z fields as a pykinect Vector
+JointPosition = namedtuple('JointPosition', ['x', 'y', 'z'])
+
+# stands in for a pykinect SkeletonPositions array during replay.
+# positions is the (NUM_JOINTS, 3) array of joint positions.
+class ReplaySkeleton(object):
+    def __init__(self, positions):
+        self.positions = positions
+
+    def __getitem__(self, joint):
+        return JointPosition(*self.positions[joint_index(joint)])
+
+
+class SensorRecorder(object):
+    def __init__(self, audio_sample_rate = 44100):
+        self.audio_sample_rate = audio_sample_rate
+
+        self.skeleton_times = []
+        self.skeleton_joints = []
+        self.skeleton_tracked = []
+
+        self.leap_times = []
+        self.leap_palms = []
+        self.leap_fingers = []
+        self.leap_num_fingers = []
+
+        self.audio_times = []
+        self.audio_blocks = []
+        self.audio_channels = []
+
+    # records the frames a Kinect (or anything with the same listener
+    # interface and frame_time) delivers to its listeners
+    def attach_kinect(self, kinect):
+        kinect.add_listener(lambda skeleton: self.record_skeleton(skeleton, kinect.frame_time))
+
+    # returns an input_func for Audio that records each input block and then
+    # passes it on to input_func
+    def wrap_input_func(self, input_func):
+        def recording_input_func(frames, num_channels):
+            self.record_audio(frames, num_channels)
+            if input_func:
+                input_func(frames, num_channels)
+        return recording_input_func
+
+    def record_skeleton(self, skeleton, t = None):
+        joints = np.zeros((NUM_JOINTS, 3), dtype=np.float32)
+        if skeleton is not None:
+            joints[:] = skeleton_to_array(skeleton)
+
+        self.skeleton_times.append(time.time() if t is None else t)
+        self.skeleton_joints.append(joints)
+        self.skeleton_tracked.append(skeleton is not None)
+
+    # palm positions and finger tip lists of both hands, the same inputs
+    # leaputil.pack_hands takes
+    def record_leap(self, left_palm, right_palm, left_fingers, right_fingers, t = None):
+        fingers = np.zeros((2, kMaxFingers, 3), dtype=np.float32)
+        num_fingers = np.zeros(2, dtype=np.int8)
+        for hand, hand_fingers in enumerate((left_fingers, right_fingers)):
+            num_fingers[hand] = min(len(hand_fingers), kMaxFingers)
+            for f in range(num_fingers[hand]):
+                fingers[hand, f] = hand_fingers[f]
+
+        self.leap_times.append(time.time() if t is None else t)
+        self.leap_palms.append(np.array((left_palm, right_palm), dtype=np.float32))
+        self.leap_fingers.append(fingers)
+        self.leap_num_fingers.append(num_fingers)
+
+    def record_audio(self, frames, num_channels, t = None):
+        self.audio_times.append(time.time() if t is None else t)
+        self.audio_blocks.append(np.array(frames, dtype=np.float32))
+        self.audio_channels.append(num_channels)
+
+    def save(self, filepath):
+        offsets = np.zeros(len(self.audio_blocks) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(block) for block in self.audio_blocks])
+        if self.audio_blocks:
+            samples = np.concatenate(self.audio_blocks)
+        else:
+            samples = np.zeros(0, dtype=np.float32)
+
+        np.savez(filepath,
+            skeleton_times = np.array(self.skeleton_times, dtype=np.float64),
+            skeleton_joints = np.array(self.skeleton_joints, dtype=np.float32).reshape(-1, NUM_JOINTS, 3),
+            skeleton_tracked = np.array(self.skeleton_tracked, dtype=bool),
+            leap_times = np.array(self.leap_times, dtype=np.float64),
+            leap_palms = np.array(self.leap_palms, dtype=np.float32).reshape(-1, 2, 3),
+            leap_fingers = np.array(self.leap_fingers, dtype=np.float32).reshape(-1, 2, kMaxFingers, 3),
+            leap_num_fingers = np.array(self.leap_num_fingers, dtype=np.int8).reshape(-1, 2),
+            audio_times = np.array(self.audio_times, dtype=np.float64),
+            audio_offsets = offsets,
+            audio_samples = samples,
+            audio_channels = np.array(self.audio_channels, dtype=np.int32),
+            audio_sample_rate = self.audio_sample_rate)
+
+
+# Replays a recording made by SensorRecorder. It has the same listener
+# interface as Kinect (add_listener, start, on_update, frame_time), calls an
+# Audio-style input_func with the recorded input blocks, and can stand in as
+# the Leap source of a GestureRecognizer through add_leap_listener().
+#
+# Events are delivered in timestamp order, with times relative to the start
+# of the recording. on_update() follows the wall clock (scaled by speed), and
+# run() delivers everything as fast as possible.
+class SensorReplay(object):
+    def __init__(self, filepath, speed = 1.0):
+        data = np.load(filepath)
+        self.skeleton_joints = data['skeleton_joints']
+        self.skeleton_tracked = data['skeleton_tracked']
+        self.leap_palms = data['leap_palms']
+        self.leap_fingers = data['leap_fingers']
+        self.leap_num_fingers = data['leap_num_fingers']
+        self.audio_offsets = data['audio_offsets']
+        self.audio_samples = data['audio_samples']
+        self.audio_channels = data['audio_channels']
+        self.audio_sample_rate = int(data['audio_sample_rate'])
+
+        # merges all streams into one timeline of (stream, index) events
+        times = (data['skeleton_times'], data['leap_times'], data['audio_times'])
+        all_times = np.concatenate(times)
+        streams = np.concatenate([np.full(len(t), s, dtype=np.int8) for s, t in enumerate(times)])
+        indices = np.concatenate([np.arange(len(t)) for t in times])
+        order = np.argsort(all_times, kind='stable')
+        start = all_times[order[0]] if len(order) else 0.0
+        self.event_times = all_times[order] - start
+        self.event_streams = streams[order]
+        self.event_indices = indices[order]
+        self.duration = self.event_times[-1] if len(order) else 0.0
+
+        self.speed = speed
+        self.listeners = []
+        self.leap_listeners = []
+        self.input_func = None
+
+        self.next_event = 0
+        self.t = 0.0
+        self.start_time = None
+        self.frame_time = None # time of the skeleton being delivered to listeners
+        self.leap_frame_time = None # time of the Leap frame being delivered to leap listeners
+
+    # same interface as Kinect.add_listener
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    # callback gets (left_palm, right_palm, left_fingers, right_fingers) for
+    # every replayed Leap frame, with the frame's time in leap_frame_time
+    def add_leap_listener(self, callback):
+        self.leap_listeners.append(callback)
+
+    # input_func gets (frames, num_channels), like Audio's input_func
+    def set_input_func(self, input_func):
+        self.input_func = input_func
+
+    def is_done(self):
+        return self.next_event >= len(self.event_times)
+
+    def rewind(self):
+        self.next_event = 0
+        self.t = 0.0
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.time() - self.t / self.speed
+
+    # replays everything up to the current wall clock time
+    def on_update(self):
+        if self.start_time is None:
+            self.start()
+        self.advance((time.time() - self.start_time) * self.speed)
+
+    # delivers all events up to time t (seconds into the recording)
+    def advance(self, t):
+        end = np.searchsorted(self.event_times, t, side='right')
+        while self.next_event < end:
+            i = self.next_event
+            self.next_event += 1
+            self._deliver(self.event_streams[i], self.event_indices[i], self.event_times[i])
+        self.t = max(self.t, t)
+
+    # delivers all remaining events without waiting
+    def run(self):
+        self.advance(np.inf)
+
+    def _deliver(self, stream, idx, t):
+        if stream == kSkeletonStream:
+            skeleton = None
+            if self.skeleton_tracked[idx]:
+                skeleton = ReplaySkeleton(self.skeleton_joints[idx])
+            self.frame_time = t
+            for listener in self.listeners:
+                listener(skeleton)
+
+        elif stream == kLeapStream:
+            num_fingers = self.leap_num_fingers[idx]
+            fingers = self.leap_fingers[idx]
+            leap_data = (self.leap_palms[idx, 0], self.leap_palms[idx, 1],
+                         list(fingers[0, :num_fingers[0]]), list(fingers[1, :num_fingers[1]]))
+            self.leap_frame_time = t
+            for listener in self.leap_listeners:
+                listener(*leap_data)
+
+        elif stream == kAudioStream:
+            if self.input_func:
+                frames = self.audio_samples[self.audio_offsets[idx]:self.audio_offsets[idx + 1]]
+                self.input_func(frames, int(self.audio_channels[idx]))
@@ -2,29 +2,61 @@ from math import *
 import numpy as np
 import sys
 from common.clock import kTicksPerQuarter
+from ring_buffer import RingBuffer
+
+# estimates the beat interval from a set of inter-onset intervals, robust to
+# a missed or doubled beat. Intervals that are a whole multiple of the median
+# (missed beats) are folded back onto it. Intervals that still lie too far
+# from the median (doubled beats, stray detections) are dropped before
+# averaging, using the median absolute deviation with a minimum tolerance.
+def robust_interval(intervals, tolerance = 0.15):
+    intervals = intervals[intervals > 0]
+    if len(intervals) == 0:
+        return None
+
+    median = np.median(intervals)
+    multiples = np.maximum(np.round(intervals / median), 1)
+    folded = intervals / multiples
+    intervals = np.where(np.abs(folded - median) <= tolerance * median, folded, intervals)
+
+    deviations = np.abs(intervals - median)
+    max_deviation = max(3 * 1.4826 * np.median(deviations), tolerance * median)
+    inliers = intervals[deviations <= max_deviation]
+    if len(inliers) == 0:
+        return median
+    return np.mean(inliers)
 
 class TempoProcessor(object):
     def __init__(self, change_tempo_func, tempo_map):
-        self.previous_up_conducts = [] # as timestamps
-        self.previous_down_conducts = [] # as timestamps
+        self.max_samples = 6
+        self.previous_up_conducts = RingBuffer(self.max_samples, dtype=np.float64) # as timestamps
+        self.previous_down_conducts = RingBuffer(self.max_samples, dtype=np.float64) # as timestamps
         self.tempo_map = tempo_map
 
         self.clear_threshold = 2.5 # in seconds
         self.change_tempo_func = change_tempo_func
 
+        # transport clock (anything with get_time(), such as the AudioScheduler
+        # that plays our notes). Until one is set, time is accumulated from dt.
+        self.clock = None
         self.t = 0
 
-        self.beat_count = None
-        self.beat = 0
+        self.beat = 0 # beats since the start of the transport, with fraction
+
+        self.beat_period = None # seconds per beat of the latest estimate
+
+    # beat and measure positions are derived from the clock's time, so they
+    # can't drift from the audio stream the way a sum of frame times does
+    def set_clock(self, clock):
+        self.clock = clock
+        self.t = clock.get_time()
 
     def on_update(self, dt):
-        self.t += dt
-        beat_count = int(float(self.tempo_map.time_to_tick(self.t)) / kTicksPerQuarter)
-        if self.beat_count is None:
-            self.beat_count = beat_count
-        elif beat_count > self.beat_count:
-            self.beat_count = beat_count
-            self.beat += 1
+        if self.clock != None:
+            self.t = self.clock.get_time()
+        else:
+            self.t += dt
+        self.beat = float(self.tempo_map.time_to_tick(self.t)) / kTicksPerQuarter
 
     def quantize_time_to_beat(self, time, round_up=True):
         bps = self.tempo_map.bpm/60.0
@@ -33,7 +65,7 @@ class TempoProcessor(object):
         return beat
 
     def current_beat(self, divisor=1, round_up=True):
-        return (self.beat // divisor) % 4
+        return int(self.beat // divisor) % 4
         #return int((self.quantize_time_to_beat(self.t, round_up)/divisor) % 4)
 
     def strong_sample_size(self):
@@ -44,19 +76,16 @@ class TempoProcessor(object):
 
     def add_sample(self, timestamp, up_or_down):
         if up_or_down == "up":
-            if len(self.previous_up_conducts) > 0 and np.abs(timestamp - self.previous_up_conducts[-1]) > self.clear_threshold:
-                self.previous_up_conducts = [timestamp]
-            else:
-                self.previous_up_conducts.append(timestamp)
-                if len(self.previous_up_conducts) > 6:
-                    self.previous_up_conducts = self.previous_up_conducts[1:]
+            conducts = self.previous_up_conducts
         elif up_or_down == "down":
-            if len(self.previous_down_conducts) > 0 and np.abs(timestamp - self.previous_down_conducts[-1]) > self.clear_threshold:
-                self.previous_down_conducts = [timestamp]
-            else:
-                self.previous_down_conducts.append(timestamp)
-                if len(self.previous_down_conducts) > 6:
-                    self.previous_down_conducts = self.previous_down_conducts[1:]
+            conducts = self.previous_down_conducts
+        else:
+            return
+
+        # a long pause starts a new tempo, so older samples are forgotten
+        if len(conducts) > 0 and np.abs(timestamp - conducts.latest(1)[0]) > self.clear_threshold:
+            conducts.clear()
+        conducts.append(timestamp)
 
         new_tempo = self.estimate_tempo(self.tempo_map.bpm)
         if new_tempo != None:
@@ -67,48 +96,25 @@ class TempoProcessor(object):
         if sample_size < 3:
             return None
 
-        time_diff_sum_down = 0
-        time_diff_count_down = 0
-        time_diff_sum_up = 0
-        time_diff_count_up = 0
-
-        # use captured downbeats to capture tempo
-        for j in range(len(self.previous_down_conducts)-1):
-            i = len(self.previous_down_conducts)-1-j
-
-            down_timestamp = self.previous_down_conducts[i]
-            earlier_down_timestamp = self.previous_down_conducts[i-1]
-
-            diff = np.abs(earlier_down_timestamp - down_timestamp)
-            time_diff_count_down += 1
-            time_diff_sum_down += diff
-
-        # use captured upbeats to influence tempo
-        for j in range(len(self.previous_up_conducts)-1):
-            i = len(self.previous_up_conducts)-1-j
-
-            up_timestamp = self.previous_up_conducts[i]
-            earlier_up_timestamp = self.previous_up_conducts[i-1]
-
-            diff = np.abs(earlier_up_timestamp - up_timestamp)
-            time_diff_count_up += 1
-            time_diff_sum_up += diff
-
-        if time_diff_count_down == 0 and time_diff_count_up == 0:
-            return None
-
-        time_diff_sum_down = time_diff_sum_down/max(time_diff_count_down, 0.0001)
-        time_diff_sum_up = time_diff_sum_up/max(time_diff_count_up, 0.0001)
-
-        time_diff_avg = (time_diff_sum_down + time_diff_sum_down + time_diff_sum_up) / 3
-        if time_diff_sum_down == 0 and time_diff_sum_up != 0:
-            time_diff_avg = time_diff_sum_up
-        elif time_diff_sum_up == 0 and time_diff_sum_down != 0:
-            time_diff_avg = time_diff_sum_down
-        elif time_diff_sum_up == 0 and time_diff_sum_down == 0:
+        # intervals between consecutive downbeats and between consecutive upbeats
+        intervals = np.abs(np.concatenate((np.diff(self.previous_down_conducts.latest(self.max_samples)),
+                                           np.diff(self.previous_up_conducts.latest(self.max_samples)))))
+        time_diff_avg = robust_interval(intervals)
+        if time_diff_avg == None:
             return None
 
-        suggested_tempo = 60.0 / (time_diff_avg * 0.5)
+        self.beat_period = time_diff_avg * 0.5
+        suggested_tempo = 60.0 / self.beat_period
 
         return (suggested_tempo * 0.75) + (reference_tempo * 0.25)
 
+    # returns how far (0 to 1) the conductor is into the current beat at the
+    # given time (default: now), measured from the latest downbeat with the
+    # latest beat period estimate. Returns None before there is an estimate.
+    def get_phase(self, time = None):
+        if time == None:
+            time = self.t
+        if self.beat_period == None or len(self.previous_down_conducts) == 0:
+            return None
+        last_downbeat = self.previous_down_conducts.latest(1)[0]
+        return ((time - last_downbeat) / self.beat_period) % 1.0